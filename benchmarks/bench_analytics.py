@@ -0,0 +1,41 @@
+'''
+Times loading the results grids into numpy and analysing them for the whole
+school.
+
+    python -m benchmarks.bench_analytics --students 20000
+'''
+import argparse
+
+from src.analytics import analyse, load_results
+
+from .common import make_app, measure, seed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, args.students)
+
+    with app.app_context():
+        loaded = {}
+
+        def load():
+            loaded['results'] = load_results()
+
+        def run_analyse():
+            analyse(*loaded['results'])
+
+        print('{} students'.format(args.students))
+        print('{:<16} {:>10} {:>12}'.format('step', 'ms', 'peak KiB'))
+        for name, fn in (('load_results', load), ('analyse', run_analyse)):
+            result = measure(fn, args.repeat)
+            print('{:<16} {:>10.1f} {:>12.0f}'.format(
+                name, result['seconds'] * 1000, result['peak_bytes'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+'''
+Compares requests per second and latency of the WSGI server (werkzeug, a
+thread per connection) and the ASGI entry point (uvicorn, src.asgi) for
+GET /students/<id> and GET /students pages with many concurrent clients.
+
+The servers are started in subprocesses against a scratch sqlite database.
+The load is generated by a minimal asyncio http client, as a full client
+library uses more cpu than the servers being measured.
+Needs the ASGI packages (pip install -r requirements-asgi.txt).
+
+    python -m benchmarks.bench_asgi --students 2000 --concurrency 1 16 64 --seconds 5
+'''
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from src.database.migrations import migrate
+
+from .common import make_app, seed
+
+WSGI_SERVER = '''
+import sys
+from werkzeug.serving import run_simple
+from src.api import app
+run_simple('127.0.0.1', int(sys.argv[1]), app, threaded=True)
+'''
+
+
+# ###################################################################
+def start_server(kind, port, env):
+    '''
+    Starts the wsgi or asgi server in a subprocess and waits until it
+    responds.
+    '''
+    if kind == 'wsgi':
+        command = [sys.executable, '-c', WSGI_SERVER, str(port)]
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'src.asgi:application',
+                   '--port', str(port), '--log-level', 'warning', '--no-access-log']
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for attempt in range(100):
+        try:
+            urlopen('http://127.0.0.1:' + str(port) + '/', timeout=1).read()
+            return process
+        except (URLError, ConnectionError):
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('The ' + kind + ' server did not start.')
+
+# ###################################################################
+async def http_get(connection, port, path):
+    '''
+    Sends a GET request on a keep alive connection, reopening it if the
+    server closed it.
+
+    @INPUTS
+        connection: list of the (reader, writer) streams, or empty to open one
+
+    Returns the response status code.
+    '''
+    if not connection:
+        connection.extend(await asyncio.open_connection('127.0.0.1', port))
+    reader, writer = connection
+    writer.write(b'GET ' + path.encode() + b' HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    status = int(head[9:12])
+    length = 0
+    close = head.startswith(b'HTTP/1.0')
+    for line in head.lower().split(b'\r\n')[1:]:
+        if line.startswith(b'content-length:'):
+            length = int(line[15:])
+        elif line.startswith(b'connection:'):
+            close = b'close' in line
+    await reader.readexactly(length)
+    if close:
+        writer.close()
+        connection.clear()
+    return status
+
+# ###################################################################
+async def run_load(port, students, concurrency, seconds, rng_seed=0):
+    '''
+    Runs concurrency clients requesting random students and pages for
+    seconds.
+
+    Returns a dict of the requests per second, latency percentiles in ms
+    and the number of errors.
+    '''
+    latencies = []
+    errors = [0]
+    deadline = time.perf_counter() + seconds
+
+    async def client(rng):
+        connection = []
+        while time.perf_counter() < deadline:
+            if rng.random() < 0.8:
+                path = '/students/' + str(rng.randint(1, students))
+            else:
+                path = '/students?limit=50&after=' + str(rng.randint(0, students - 50))
+            start = time.perf_counter()
+            try:
+                if await http_get(connection, port, path) != 200:
+                    errors[0] += 1
+            except (OSError, asyncio.IncompleteReadError):
+                errors[0] += 1
+                connection.clear()
+            latencies.append(time.perf_counter() - start)
+        if connection:
+            connection[1].close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(random.Random(rng_seed + i)) for i in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(50),
+        'p99': percentile(99),
+        'errors': errors[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache', default='none', help='CACHE_BACKEND for the servers (default none)')
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, args.students)
+    with app.app_context():
+        migrate()
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = app.config['SQLALCHEMY_DATABASE_URI']
+    env['CACHE_BACKEND'] = args.cache
+    env['PYTHONPATH'] = os.getcwd()
+
+    print('{} students, cache {}'.format(args.students, args.cache))
+    print('{:<6} {:>12} {:>10} {:>10} {:>10} {:>8}'.format('server', 'concurrency', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for kind in ('wsgi', 'asgi'):
+        process = start_server(kind, args.port, env)
+        try:
+            for concurrency in args.concurrency:
+                result = asyncio.run(run_load(args.port, args.students, concurrency, args.seconds))
+                print('{:<6} {:>12} {:>10.0f} {:>10.1f} {:>10.1f} {:>8}'.format(
+                    kind, concurrency, result['rps'], result['p50'], result['p99'], result['errors']))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
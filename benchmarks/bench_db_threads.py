@@ -0,0 +1,89 @@
+'''
+Load test of concurrent database reads and writes from several threads.
+
+Each thread repeatedly reads a random student's long form or records a
+result for a random student.  Against a sqlite file each journal mode is
+compared; set --database-url (or DATABASE_URL) to load test postgres.
+
+    python -m benchmarks.bench_db_threads --students 2000 --threads 1 4 8
+    python -m benchmarks.bench_db_threads --database-url postgresql://localhost/abimath_bench
+'''
+import argparse
+import os
+import random
+import threading
+import time
+
+from src.database import models
+from src.database.models import Student, db, db_rollback, record_results
+
+from .common import make_app, seed
+
+
+def run_load(app, students, threads, seconds, write_ratio):
+    '''
+    Runs the workload on threads threads for seconds seconds.
+
+    Returns a dict of the operations per second and the number of errors.
+    '''
+    counts = [0] * threads
+    errors = [0] * threads
+    deadline = time.perf_counter() + seconds
+
+    def worker(index):
+        rng = random.Random(index)
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                student_id = rng.randint(1, students)
+                try:
+                    if rng.random() < write_ratio:
+                        record_results(student_id, [('mul', rng.randint(1, 10), rng.randint(1, 10), True)])
+                    else:
+                        Student.query.filter(Student.id == student_id).one().long()
+                        db.session.commit()
+                    counts[index] += 1
+                except Exception:
+                    db_rollback()
+                    errors[index] += 1
+            db.session.remove()
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {'ops_per_second': sum(counts) / elapsed, 'errors': sum(errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL'))
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--write-ratio', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.database_url and not args.database_url.startswith('sqlite'):
+        journal_modes = [None]
+    else:
+        journal_modes = ['DELETE', 'WAL']
+
+    print('{:<10} {:>8} {:>12} {:>8}'.format('journal', 'threads', 'ops/s', 'errors'))
+    for journal_mode in journal_modes:
+        if journal_mode is not None:
+            models.SQLITE_JOURNAL_MODE = journal_mode
+        app = make_app(None if journal_mode else args.database_url)
+        seed(app, args.students)
+        for threads in args.threads:
+            result = run_load(app, args.students, threads, args.seconds, args.write_ratio)
+            print('{:<10} {:>8} {:>12.0f} {:>8}'.format(
+                journal_mode or 'server', threads, result['ops_per_second'], result['errors']))
+        with app.app_context():
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
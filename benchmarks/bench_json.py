@@ -0,0 +1,52 @@
+'''
+Compares serializing Student.long() payloads with flask.jsonify and the
+src.jsonio encoders (stdlib and orjson when installed).
+
+    python -m benchmarks.bench_json --sizes 1 100 10000
+'''
+import argparse
+import json
+
+from flask import jsonify
+
+from src import jsonio
+from src.database.models import Student
+
+from .common import make_app, measure, seed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, max(args.sizes))
+
+    with app.app_context():
+        students = [student.long() for student in Student.query.order_by(Student.id).limit(max(args.sizes))]
+
+        cases = {
+            'flask.jsonify': lambda payload: jsonify(payload).get_data(),
+            'json.dumps (defaults)': lambda payload: json.dumps(payload).encode(),
+            'jsonio stdlib': lambda payload: jsonio._encoder.encode(payload).encode('utf-8'),
+        }
+        if jsonio.orjson is not None:
+            cases['jsonio orjson'] = lambda payload: jsonio.orjson.dumps(payload)
+        else:
+            print('orjson is not installed, pip install orjson to include it')
+
+        for size in args.sizes:
+            payload = {'success': True, 'students': students[:size], 'next_after': None}
+            print('{} students'.format(size))
+            print('{:<24} {:>10} {:>12} {:>12}'.format('case', 'ms', 'peak KiB', 'bytes'))
+            for name, fn in cases.items():
+                result = measure(lambda: fn(payload), args.repeat)
+                print('{:<24} {:>10.3f} {:>12.0f} {:>12}'.format(
+                    name, result['seconds'] * 1000, result['peak_bytes'] / 1024, len(fn(payload))))
+            print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Compares loading the short form of the students with and without the
+results columns.
+
+    python -m benchmarks.bench_short_listing --students 10000
+'''
+import argparse
+
+from src.database.models import Student, db
+
+from .common import make_app, measure, seed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--students', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, args.students)
+
+    cases = {
+        'query.all() + short()':
+            lambda: [student.short() for student in Student.query.all()],
+        'query_short().all() + short()':
+            lambda: [student.short() for student in Student.query_short().all()],
+    }
+
+    with app.app_context():
+        print('{} students'.format(args.students))
+        print('{:<32} {:>10} {:>12}'.format('case', 'ms', 'peak KiB'))
+        for name, fn in cases.items():
+            def run():
+                fn()
+                db.session.expunge_all()
+            result = measure(run, args.repeat)
+            print('{:<32} {:>10.1f} {:>12.0f}'.format(
+                name, result['seconds'] * 1000, result['peak_bytes'] / 1024))
+
+
+if __name__ == '__main__':
+    main()
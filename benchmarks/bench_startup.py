@@ -0,0 +1,73 @@
+'''
+Measures the server start up time, which only checks the schema version,
+against the cost of the old start up which dropped and reseeded the
+database.
+
+It exits with status 1 if starting the server changed the students, i.e.
+if the start up dropped or reseeded the database.
+
+    python -m benchmarks.bench_startup --students 10000
+'''
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from src.database.migrations import db_drop_and_create_all, migrate, verify_schema
+from src.database.models import Student
+
+from .common import make_app, seed
+
+# imports the app in a fresh interpreter and prints the seconds it took
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import src.api
+print(time.perf_counter() - start)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--students', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = make_app()
+    seed(app, args.students)
+    with app.app_context():
+        migrate()
+    database_url = app.config['SQLALCHEMY_DATABASE_URI']
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=root)
+    startups = []
+    for i in range(args.repeat):
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=environment, cwd=root,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+        startups.append(float(output.stdout.decode().strip().splitlines()[-1]))
+
+    with app.app_context():
+        students = Student.query.count()
+        start = time.perf_counter()
+        verify_schema()
+        verify = time.perf_counter() - start
+        start = time.perf_counter()
+        db_drop_and_create_all()
+        reset = time.perf_counter() - start
+
+    print('{} students'.format(args.students))
+    print('{:<44} {:>10}'.format('step', 'ms'))
+    print('{:<44} {:>10.1f}'.format('import src.api in a new process (best)', min(startups) * 1000))
+    print('{:<44} {:>10.1f}'.format('import src.api in a new process (worst)', max(startups) * 1000))
+    print('{:<44} {:>10.1f}'.format('verify_schema (the new start up step)', verify * 1000))
+    print('{:<44} {:>10.1f}'.format('db_drop_and_create_all (the old step)', reset * 1000))
+
+    if students != args.students:
+        print('Starting the server changed the students from {} to {}'.format(args.students, students))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
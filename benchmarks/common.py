@@ -0,0 +1,108 @@
+'''
+Shared helpers for the benchmark scripts.
+
+Run the benchmarks from the project root, for example
+
+    python -m benchmarks.bench_short_listing --students 10000
+'''
+import gc
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from flask import Flask
+
+from src.database.models import Class, Student, db, setup_db
+
+
+# ###################################################################
+def make_app(database_url=None):
+    '''
+    Creates a flask app bound to a scratch database.
+
+    If database_url is not supplied a new sqlite file in the temp directory
+    is used.
+    '''
+    if database_url is None:
+        handle, path = tempfile.mkstemp(prefix='abimath-bench-', suffix='.db')
+        os.close(handle)
+        database_url = 'sqlite:///' + path
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    return app
+
+
+# ###################################################################
+def random_grid(rng, density=0.6, maximum=20):
+    '''
+    Builds a 10x10 results grid with roughly density of the cells non-zero.
+    '''
+    return [[rng.randint(1, maximum) if rng.random() < density else 0
+             for col in range(10)] for row in range(10)]
+
+
+# ###################################################################
+def seed(app, students, classes=None, rng_seed=0):
+    '''
+    Drops and recreates the tables and inserts a deterministic dataset.
+
+    The students are spread evenly over the classes (default one class per
+    25 students) and have random non-zero results grids.
+    '''
+    rng = random.Random(rng_seed)
+    if classes is None:
+        classes = max(1, students // 25)
+    zero = [[0] * 10 for row in range(10)]
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(Class, [{
+            'id': class_id,
+            'classname': 'Class ' + str(class_id),
+            'addresults': zero,
+            'subresults': zero,
+            'mulresults': zero,
+            'divresults': zero
+        } for class_id in range(1, classes + 1)])
+        batch = []
+        for student_id in range(1, students + 1):
+            batch.append({
+                'id': student_id,
+                'class_id': (student_id - 1) % classes + 1,
+                'name': 'Student ' + str(student_id),
+                'addresults': random_grid(rng),
+                'subresults': random_grid(rng),
+                'mulresults': random_grid(rng),
+                'divresults': random_grid(rng)
+            })
+            if len(batch) == 5000:
+                db.session.bulk_insert_mappings(Student, batch)
+                batch = []
+        db.session.bulk_insert_mappings(Student, batch)
+        db.session.commit()
+
+
+# ###################################################################
+def measure(fn, repeat=3):
+    '''
+    Times fn and measures its peak python memory allocation.
+
+    Returns a dict of the best wall time in seconds over repeat runs and
+    the peak traced memory in bytes of a separate run.
+    '''
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
@@ -0,0 +1,106 @@
+'''
+Deterministic synthetic school datasets for the benchmark suite.
+
+The results grids are modelled on students practising over a term:
+    - each student has a skill level and has practised each operation for
+      a different amount of time (some not at all, e.g. division),
+    - the number of attempts at a fact falls off for the larger numbers,
+    - the chance of a correct answer depends on the skill and on how hard
+      the fact is,
+    - a cell holds the correct answers minus the incorrect answers.
+So most grids have a mix of positive, negative and zero cells, and the
+later operations are often all zero, like the real data.
+
+The class results are the totals of their students, as the server keeps them.
+'''
+import numpy as np
+
+from src.cache import cache
+from src.database.migrations import migrate, schema_metadata
+from src.database.models import Class, Student, db, GRID_SIZE, RESULTS_COLUMNS
+from src.practice import samplers
+
+# the relative amount each operation has been practised
+OPERATION_PRACTICE = np.array([1.0, 0.7, 0.5, 0.25])
+
+
+# ###################################################################
+def fact_difficulty():
+    '''
+    Returns a (4, 10, 10) array of the difficulty of each fact, growing
+    with the size of the numbers and with the operation.
+    '''
+    numbers = np.arange(1, GRID_SIZE + 1)
+    size = (numbers[:, None] + numbers[None, :]) / (2.0 * GRID_SIZE)
+    operation = np.array([0.0, 0.3, 0.6, 0.9])
+    return operation[:, None, None] + 2.0 * size[None, :, :]
+
+# ###################################################################
+def school_grids(rng, count):
+    '''
+    Generates the results grids of count students.
+
+    Returns an int array of shape (count, 4, 10, 10).
+    '''
+    skill = rng.normal(1.2, 0.6, size=(count, 1, 1, 1))
+    # how far through the term each student is with each operation
+    exposure = rng.gamma(2.0, 2.0, size=(count, 4, 1, 1)) * OPERATION_PRACTICE[None, :, None, None]
+    exposure[rng.random((count, 4, 1, 1)) < 0.15 * np.arange(1, 5)[None, :, None, None]] = 0.0
+
+    difficulty = fact_difficulty()[None, :, :, :]
+    attempts = rng.poisson(exposure * np.exp(-0.8 * difficulty))
+    correct = rng.binomial(attempts, 1.0 / (1.0 + np.exp(difficulty - skill)))
+    return 2 * correct - attempts
+
+# ###################################################################
+def seed_school(app, students, class_size=25, rng_seed=0, batch_size=5000):
+    '''
+    Drops the tables, migrates a fresh schema and inserts a deterministic
+    school of students in classes of class_size.  The in-process response
+    cache and practice samplers are cleared as the ids are reused.
+
+    Returns the number of classes.
+    '''
+    rng = np.random.default_rng(rng_seed)
+    classes = max(1, (students + class_size - 1) // class_size)
+    totals = np.zeros((classes, len(RESULTS_COLUMNS), GRID_SIZE, GRID_SIZE), dtype=np.int64)
+
+    with app.app_context():
+        db.drop_all()
+        schema_metadata.drop_all(bind=db.engine, checkfirst=True)
+        migrate()
+
+        # the classes are inserted first for the foreign keys, and their
+        # totals are updated once all the students are inserted
+        zero = [[0] * GRID_SIZE for row in range(GRID_SIZE)]
+        db.session.bulk_insert_mappings(Class, [
+            dict({'id': index + 1, 'classname': 'Class ' + str(index + 1)},
+                 **{name: zero for name in RESULTS_COLUMNS})
+            for index in range(classes)])
+
+        for start in range(0, students, batch_size):
+            count = min(batch_size, students - start)
+            grids = school_grids(rng, count)
+            class_index = np.arange(start, start + count) // class_size
+            np.add.at(totals, class_index, grids)
+            rows = []
+            for offset, student_grids in enumerate(grids.tolist()):
+                row = {
+                    'id': start + offset + 1,
+                    'class_id': int(class_index[offset]) + 1,
+                    'name': 'Student ' + str(start + offset + 1)
+                }
+                row.update(zip(RESULTS_COLUMNS, student_grids))
+                rows.append(row)
+            db.session.bulk_insert_mappings(Student, rows)
+
+        class_rows = []
+        for index, class_grids in enumerate(totals.tolist()):
+            row = {'id': index + 1}
+            row.update(zip(RESULTS_COLUMNS, class_grids))
+            class_rows.append(row)
+        db.session.bulk_update_mappings(Class, class_rows)
+        db.session.commit()
+    cache.clear()
+    samplers.clear()
+    return classes
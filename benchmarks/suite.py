@@ -0,0 +1,482 @@
+'''
+Endpoint benchmark suite.
+
+For each dataset size a deterministic school is generated (see datasets.py)
+and every endpoint is driven through the flask test client, then a mix of
+the read endpoints is driven from several threads at once.  For each case
+the throughput, p50/p95/p99 latency, SQL statements per request and peak
+python memory of one request are reported, and everything is saved as json
+so runs can be compared between commits.
+
+It also checks that listing classes with their members takes the same
+number of SQL statements for 1, 10 or 100 classes (no query per class),
+and exits with status 1 if it does not (tests/test_class_statements.py
+checks the same in the tests).
+
+    python -m benchmarks.suite --sizes 100 10000 100000
+    python -m benchmarks.suite --sizes 10000 --compare benchmarks/results/<commit>.json
+
+The response cache is off by default so the endpoints' real cost is
+measured; use --cache memory to measure cached responses.
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'results')
+
+# the mix of read requests made by the load generator threads
+LOAD_MIX = (
+    (0.7, lambda rng, state: '/students/' + str(rng.randint(1, state['students']))),
+    (0.15, lambda rng, state: '/students?limit=100&after=' + str(rng.randint(0, max(0, state['students'] - 100)))),
+    (0.1, lambda rng, state: '/students-detail?limit=20&after=' + str(rng.randint(0, max(0, state['students'] - 20)))),
+    (0.05, lambda rng, state: '/classes/' + str(rng.randint(1, state['classes'])) + '/results'),
+)
+
+
+# ###################################################################
+def random_student(rng, state):
+    return rng.randint(1, state['students'])
+
+# ###################################################################
+def random_class(rng, state):
+    return rng.randint(1, state['classes'])
+
+# ###################################################################
+def random_results(rng, count=20):
+    return {'results': [{
+        'operation': rng.choice(('add', 'sub', 'mul', 'div')),
+        'a': rng.randint(1, 10),
+        'b': rng.randint(1, 10),
+        'correct': rng.random() < 0.7
+    } for i in range(count)]}
+
+# ###################################################################
+def practised_student(rng, state):
+    '''
+    Chooses a student whose results were recorded by the suite, or any
+    student if none were.
+    '''
+    if not state['practised']:
+        return random_student(rng, state)
+    return rng.choice(state['practised'])
+
+# ###################################################################
+def created_student(rng, state):
+    return state['created'].pop()
+
+# ###################################################################
+def bench_students(state):
+    '''
+    Finds the ids of the students added by the suite.
+    '''
+    from src.database.models import Student
+    return [row.id for row in Student.query.with_entities(Student.id).filter(Student.name.like('Bench %'))]
+
+
+# the cases as (name, heavy, request) where request(rng, state, index)
+# returns (method, url, json); heavy cases are run fewer times
+CASES = (
+    ('GET /', False,
+        lambda rng, state, i: ('GET', '/', None)),
+    ('GET /students', False,
+        lambda rng, state, i: ('GET', '/students', None)),
+    ('GET /students?class_id', False,
+        lambda rng, state, i: ('GET', '/students?class_id=' + str(random_class(rng, state)), None)),
+    ('GET /students-detail', False,
+        lambda rng, state, i: ('GET', '/students-detail', None)),
+    ('GET /students-detail?format=sparse', False,
+        lambda rng, state, i: ('GET', '/students-detail?format=sparse', None)),
+    ('GET /students-detail?stream=ndjson', True,
+        lambda rng, state, i: ('GET', '/students-detail?stream=ndjson', None)),
+    ('GET /students/<id>', False,
+        lambda rng, state, i: ('GET', '/students/' + str(random_student(rng, state)), None)),
+    ('GET /students/<id>?format=sparse', False,
+        lambda rng, state, i: ('GET', '/students/' + str(random_student(rng, state)) + '?format=sparse', None)),
+    ('GET /students/<id>/next-questions', False,
+        lambda rng, state, i: ('GET', '/students/' + str(random_student(rng, state)) + '/next-questions', None)),
+    ('GET /classes/<id>/results', False,
+        lambda rng, state, i: ('GET', '/classes/' + str(random_class(rng, state)) + '/results', None)),
+    ('GET /classes/<id>/analytics', False,
+        lambda rng, state, i: ('GET', '/classes/' + str(random_class(rng, state)) + '/analytics', None)),
+    ('GET /analytics', True,
+        lambda rng, state, i: ('GET', '/analytics', None)),
+    ('GET /classes', False,
+        lambda rng, state, i: ('GET', '/classes', None)),
+    ('GET /classes?members=short', False,
+        lambda rng, state, i: ('GET', '/classes?members=short', None)),
+    ('GET /classes?members=long', True,
+        lambda rng, state, i: ('GET', '/classes?members=long', None)),
+    ('GET /classes/<id>?members=long', False,
+        lambda rng, state, i: ('GET', '/classes/' + str(random_class(rng, state)) + '?members=long', None)),
+    ('POST /students/<id>/results', False,
+        lambda rng, state, i: ('POST', '/students/' + str(random_student(rng, state)) + '/results', random_results(rng))),
+    # after the results are recorded, so the students have changes since
+    # version 0 to send
+    ('GET /students/<id>?since', False,
+        lambda rng, state, i: ('GET', '/students/' + str(practised_student(rng, state)) + '?since=0', None)),
+    ('POST /students', False,
+        lambda rng, state, i: ('POST', '/students', {
+            'name': 'Bench ' + str(state['run']) + '-' + str(i), 'class_id': random_class(rng, state)})),
+    ('PATCH /students/<id>', False,
+        lambda rng, state, i: ('PATCH', '/students/' + str(state['created'][i % len(state['created'])]), {
+            'name': 'Bench renamed ' + str(state['run']) + '-' + str(i)})),
+    ('DELETE /students/<id>', False,
+        lambda rng, state, i: ('DELETE', '/students/' + str(created_student(rng, state)), None)),
+    ('POST /students/bulk', False,
+        lambda rng, state, i: ('POST', '/students/bulk', {'students': [{
+            'name': 'Bench bulk ' + str(state['run']) + '-' + str(i) + '-' + str(n),
+            'class_id': random_class(rng, state)} for n in range(50)]})),
+    ('DELETE /students/bulk', False,
+        lambda rng, state, i: ('DELETE', '/students/bulk', {'ids': [state['created'].pop() for n in range(50)]})),
+    ('POST /classes', False,
+        lambda rng, state, i: ('POST', '/classes', {'name': 'Bench ' + str(state['run']) + '-' + str(i)})),
+    ('PATCH /classes/<id>', False,
+        lambda rng, state, i: ('PATCH', '/classes/' + str(state['created_classes'][i % len(state['created_classes'])]), {
+            'name': 'Bench renamed ' + str(state['run']) + '-' + str(i)})),
+    ('DELETE /classes/<id>', False,
+        lambda rng, state, i: ('DELETE', '/classes/' + str(state['created_classes'].pop()), None)),
+)
+
+# the cases that change the data, whose peak memory is not measured with
+# an extra request
+WRITE_CASES = ('POST /students', 'PATCH /students/<id>', 'DELETE /students/<id>', 'POST /students/bulk',
+               'DELETE /students/bulk', 'POST /classes', 'PATCH /classes/<id>', 'DELETE /classes/<id>')
+
+# the requests whose SQL statement count must not grow with the number of
+# classes listed, each made with limit=1, 10 and 100
+STATEMENT_CHECKS = (
+    '/classes?members=none',
+    '/classes?members=short',
+    '/classes?members=long',
+)
+
+
+# ###################################################################
+def percentiles(latencies):
+    '''
+    Returns the p50, p95 and p99 of a list of latencies in seconds, in ms.
+    '''
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'p50': None, 'p95': None, 'p99': None}
+    return {'p' + str(p): latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+            for p in (50, 95, 99)}
+
+# ###################################################################
+class StatementCounter:
+    '''
+    StatementCounter. Counts the SQL statements executed by an engine.
+    '''
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._execute)
+
+    def _execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+# ###################################################################
+def run_case(client, counter, state, name, request, requests, rng):
+    '''
+    Runs one case requests times and measures it.
+
+    Returns a dict of the case results.
+    '''
+    latencies = []
+    statuses = {}
+    response_bytes = 0
+    statements = counter.count
+    started = time.perf_counter()
+    for index in range(requests):
+        method, url, body = request(rng, state, index)
+        start = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        data = response.get_data()
+        latencies.append(time.perf_counter() - start)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        response_bytes += len(data)
+        if method == 'POST' and url == '/students' and response.status_code == 200:
+            state['created'].append(json.loads(data)['students'][0]['id'])
+        if method == 'POST' and url == '/classes' and response.status_code == 200:
+            state['created_classes'].append(json.loads(data)['classes'][0]['id'])
+        if method == 'POST' and url.endswith('/results') and response.status_code == 200:
+            state['practised'].append(json.loads(data)['id'])
+    elapsed = time.perf_counter() - started
+    statements = counter.count - statements
+
+    # the peak memory of one more request, traced separately as tracing is slow
+    if name not in WRITE_CASES:
+        method, url, body = request(rng, state, requests)
+        tracemalloc.start()
+        client.open(url, method=method, json=body).get_data()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak_bytes = None
+
+    result = {
+        'requests': requests,
+        'throughput': requests / elapsed,
+        'statements_per_request': statements / requests,
+        'response_bytes': response_bytes // requests,
+        'peak_bytes': peak_bytes,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())}
+    }
+    result.update(percentiles(latencies))
+    return result
+
+# ###################################################################
+def check_statements(client, counter, url, limits=(1, 10, 100)):
+    '''
+    Counts the SQL statements of a request for pages of limits classes.
+
+    Returns a dict of the statement counts and the number of classes listed
+    by limit, and whether the counts are all the same.  They are only
+    counted as the same if pages of at least two different sizes were
+    listed, as a school with a single class proves nothing.
+    '''
+    counts = {}
+    listed = {}
+    for limit in limits:
+        statements = counter.count
+        response = client.get(url + '&limit=' + str(limit))
+        data = response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(url + ' returned ' + str(response.status_code))
+        counts[str(limit)] = counter.count - statements
+        listed[str(limit)] = len(json.loads(data)['classes'])
+    constant = len(set(counts.values())) == 1 and len(set(listed.values())) > 1
+    return {'statements': counts, 'classes': listed, 'constant': constant}
+
+# ###################################################################
+def run_load(app, counter, state, threads, seconds, rng_seed=0):
+    '''
+    Drives the LOAD_MIX read requests from threads threads for seconds.
+
+    Returns a dict of the load results.
+    '''
+    latencies = []
+    errors = [0]
+    statements = counter.count
+    deadline = time.perf_counter() + seconds
+    weights = [weight for weight, url in LOAD_MIX]
+    urls = [url for weight, url in LOAD_MIX]
+
+    def worker(index):
+        rng = random.Random(rng_seed + index)
+        client = app.test_client()
+        while time.perf_counter() < deadline:
+            url = rng.choices(urls, weights)[0](rng, state)
+            start = time.perf_counter()
+            response = client.get(url)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors[0] += 1
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {
+        'threads': threads,
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'statements_per_request': (counter.count - statements) / max(1, len(latencies)),
+        'errors': errors[0]
+    }
+    result.update(percentiles(latencies))
+    return result
+
+# ###################################################################
+def git_commit():
+    '''
+    Returns the current git commit, or None outside a git checkout.
+    '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ###################################################################
+def print_case(name, result):
+    print('{:<38} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.1f} {:>10} {:>10}'.format(
+        name, result['throughput'], result['p50'], result['p95'], result['p99'], result['statements_per_request'],
+        result['response_bytes'], '-' if result['peak_bytes'] is None else result['peak_bytes'] // 1024))
+
+# ###################################################################
+def compare(results, baseline):
+    '''
+    Prints the change in throughput and p95 latency of each case from a
+    baseline run.
+    '''
+    print('compared with {} ({})'.format(baseline.get('commit'), baseline.get('timestamp')))
+    print('{:<8} {:<38} {:>12} {:>12}'.format('size', 'case', 'throughput', 'p95'))
+    for size, dataset in results['datasets'].items():
+        old_dataset = baseline['datasets'].get(size)
+        if old_dataset is None:
+            continue
+        for name, result in dataset['cases'].items():
+            old = old_dataset['cases'].get(name)
+            if old is None:
+                continue
+            print('{:<8} {:<38} {:>+11.0f}% {:>+11.0f}%'.format(
+                size, name,
+                (result['throughput'] / old['throughput'] - 1) * 100,
+                (result['p95'] / old['p95'] - 1) * 100 if old['p95'] else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000])
+    parser.add_argument('--requests', type=int, default=50, help='requests per case (heavy cases run a tenth)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--seconds', type=float, default=5, help='duration of each load run')
+    parser.add_argument('--cache', default='none', help='CACHE_BACKEND (default none)')
+    parser.add_argument('--database-url', default=None, help='database to use (default a scratch sqlite file)')
+    parser.add_argument('--cases', nargs='*', default=None, help='only run the cases containing these strings')
+    parser.add_argument('--output', default=None, help='json results file (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', default=None, help='json results of an earlier run to compare with')
+    args = parser.parse_args()
+
+    # the server settings are read when the app is imported
+    if args.database_url is None:
+        handle, path = tempfile.mkstemp(prefix='abimath-suite-', suffix='.db')
+        os.close(handle)
+        args.database_url = 'sqlite:///' + path
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ['CACHE_BACKEND'] = args.cache
+    # the per request records would be timed with each request and mixed
+    # in with the results table
+    os.environ['LOG_REQUESTS'] = 'false'
+
+    from src.database.migrations import migrate
+
+    from .common import make_app
+
+    # the server refuses to start on an out of date schema
+    with make_app(args.database_url).app_context():
+        migrate()
+
+    from src.api import app
+    from src.database.models import bulk_delete_students, db
+
+    from .datasets import seed_school
+
+    # other info and debug records would also be mixed in with the results
+    logging.disable(logging.INFO)
+
+    commit = git_commit()
+    results = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'database': args.database_url.split(':')[0],
+            'cache': args.cache,
+            'requests': args.requests,
+            'seconds': args.seconds
+        },
+        'datasets': {}
+    }
+
+    client = app.test_client()
+    failures = 0
+    for size in args.sizes:
+        started = time.perf_counter()
+        classes = seed_school(app, size)
+        seed_seconds = time.perf_counter() - started
+        print()
+        print('{} students in {} classes (generated in {:.1f}s)'.format(size, classes, seed_seconds))
+        print('{:<38} {:>9} {:>9} {:>9} {:>9} {:>7} {:>10} {:>10}'.format(
+            'case', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'sql', 'bytes', 'peak KiB'))
+
+        state = {'students': size, 'classes': classes, 'created': [], 'created_classes': [], 'practised': [],
+                 'run': 0}
+        rng = random.Random(size)
+        dataset = {'students': size, 'classes': classes, 'seed_seconds': seed_seconds, 'cases': {}, 'load': [],
+                   'statement_checks': {}}
+        with app.app_context():
+            counter = StatementCounter(db.engine)
+            for name, heavy, request in CASES:
+                if args.cases and not any(part in name for part in args.cases):
+                    continue
+                requests = max(3, args.requests // 10) if heavy else args.requests
+                if name == 'PATCH /students/<id>' and not state['created']:
+                    continue
+                if name == 'PATCH /classes/<id>' and not state['created_classes']:
+                    continue
+                if name == 'DELETE /classes/<id>':
+                    requests = len(state['created_classes'])
+                if name == 'DELETE /students/<id>':
+                    requests = min(requests, len(state['created']) // 2)
+                if name == 'DELETE /students/bulk':
+                    state['created'] = bench_students(state)
+                    requests = min(requests, len(state['created']) // 50)
+                if requests == 0:
+                    continue
+                result = run_case(client, counter, state, name, request, requests, rng)
+                dataset['cases'][name] = result
+                print_case(name, result)
+
+            # remove the students added by the write cases
+            remaining = bench_students(state)
+            if remaining:
+                bulk_delete_students(remaining)
+
+            # listing classes with their members must take the same number
+            # of statements however many classes are listed
+            for url in STATEMENT_CHECKS:
+                check = check_statements(client, counter, url)
+                dataset['statement_checks'][url] = check
+                failures += 0 if check['constant'] else 1
+                print('{:<38} {} {}'.format(url, 'ok' if check['constant'] else 'FAILED',
+                                            ' '.join(limit + ':' + str(count)
+                                                     for limit, count in check['statements'].items())))
+
+            print('{:<10} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}'.format(
+                'threads', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'sql', 'errors'))
+            for threads in args.threads:
+                result = run_load(app, counter, state, threads, args.seconds)
+                dataset['load'].append(result)
+                print('{:<10} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.1f} {:>8}'.format(
+                    threads, result['throughput'], result['p50'], result['p95'], result['p99'],
+                    result['statements_per_request'], result['errors']))
+        results['datasets'][str(size)] = dataset
+
+    output = args.output or os.path.join(RESULTS_DIRECTORY, (commit or 'results') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print()
+    print('Saved the results to ' + output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+    if failures:
+        print(str(failures) + ' statement count checks FAILED')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
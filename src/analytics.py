@@ -0,0 +1,168 @@
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.sql import column, select, table
+
+from .database.models import Student, GRID_SIZE, OPERATION_COLUMNS, db
+
+# the operations in the order of the second axis of the results array
+OPERATIONS = tuple(OPERATION_COLUMNS)
+
+# the characters removed from JSON grids before parsing the numbers
+STRIP_BRACKETS = str.maketrans('', '', '[]')
+
+# the students' rows fetched at a time, so only one chunk of the raw grids
+# is held in python objects at once
+FETCH_ROWS = 5000
+
+# ###################################################################
+def grids_to_array(values):
+    '''
+    Converts results grids as returned by the database driver into an
+    integer array of shape (len(values), 10, 10), int32 for binary grids
+    and int64 otherwise.
+
+    Binary grids are joined and read straight from their bytes and JSON
+    grids are parsed as one string of numbers, so no python list is built
+    per grid.
+    '''
+    if len(values) == 0:
+        return np.zeros((0, GRID_SIZE, GRID_SIZE), dtype=np.int64)
+    first = values[0]
+    if isinstance(first, (bytes, bytearray, memoryview)):
+        cells = np.frombuffer(b''.join(values), dtype='<i4')
+    elif isinstance(first, str):
+        cells = np.fromstring(','.join(values).translate(STRIP_BRACKETS), dtype=np.int64, sep=',')
+    else:
+        cells = np.asarray(values, dtype=np.int64)
+    return cells.reshape(-1, GRID_SIZE, GRID_SIZE)
+
+# ###################################################################
+def load_results(class_id=None):
+    '''
+    Loads the results grids of the students in a class, or the whole school
+    if class_id is None.
+
+    The grids are selected without the model column types so they reach
+    numpy without being decoded into python lists first.  They are streamed
+    FETCH_ROWS students at a time into arrays allocated once from a count of
+    the students.
+
+    With RESULTS_STORAGE=binary the grids are read with np.frombuffer and
+    the whole school loads in a fraction of a second; the json grids have
+    to be parsed, which takes about three times as long (see the README),
+    so binary storage is the one to use for large schools.
+
+    Returns a tuple of an array of the student ids and an int32 array of
+    shape (students, 4 operations, 10, 10) holding their results.
+    '''
+    names = [OPERATION_COLUMNS[operation] for operation in OPERATIONS]
+    raw = table(Student.__tablename__, column('id'), column('class_id'), *[column(name) for name in names])
+    query = select(raw.c.id, *[raw.c[name] for name in names]).order_by(raw.c.id)
+    count = select(func.count()).select_from(raw)
+    if class_id is not None:
+        query = query.where(raw.c.class_id == class_id)
+        count = count.where(raw.c.class_id == class_id)
+
+    students = db.session.execute(count).scalar()
+    ids = np.zeros(students, dtype=np.int64)
+    results = np.zeros((students, len(names), GRID_SIZE, GRID_SIZE), dtype=np.int32)
+    loaded = 0
+    for rows in db.session.execute(query.execution_options(stream_results=True)).partitions(FETCH_ROWS):
+        # students added since the count are left out
+        rows = rows[:students - loaded]
+        end = loaded + len(rows)
+        ids[loaded:end] = [row[0] for row in rows]
+        results[loaded:end] = grids_to_array([value for row in rows for value in row[1:]]) \
+            .reshape(len(rows), len(names), GRID_SIZE, GRID_SIZE)
+        loaded = end
+    # and students deleted since the count are trimmed off
+    return ids[:loaded], results[:loaded]
+
+# ###################################################################
+def fact_list(operation_index, flat_indexes, means):
+    '''
+    Describes facts given by their flattened (row * 10 + col) indexes.
+
+    Returns a list of {"operation", "a", "b", "mean"} dicts.
+    '''
+    facts = []
+    for flat_index in flat_indexes:
+        row, col = divmod(int(flat_index), GRID_SIZE)
+        facts.append({
+            'operation': OPERATIONS[operation_index],
+            'a': row + 1,
+            'b': col + 1,
+            'mean': round(float(means[row, col]), 3)
+        })
+    return facts
+
+# ###################################################################
+def analyse(ids, results, weakest=10, ranking_limit=100):
+    '''
+    Computes the difficulty of each fact and the ranking of each student.
+
+    @INPUTS
+        ids: array of student ids (see load_results)
+        results: array of shape (students, 4, 10, 10) (see load_results)
+        weakest: number of weakest facts to return overall and per operation
+        ranking_limit: number of top ranked students to return
+
+    Returns a dict of
+        students       the number of students
+        operations     per operation: the mean of each fact as a 10x10 grid,
+                       the mean and p10/p25/p50/p75/p90 of the student totals
+                       and the weakest facts
+        weakest_facts  the facts with the lowest mean result over all operations
+        rankings       students ordered by their total result, with their
+                       per operation totals and percentile
+    '''
+    count = len(ids)
+    fact_means = results.mean(axis=0)
+    operation_totals = results.sum(axis=(2, 3))
+    totals = operation_totals.sum(axis=1)
+    percentile_points = [10, 25, 50, 75, 90]
+
+    operations = {}
+    for index, operation in enumerate(OPERATIONS):
+        means = fact_means[index]
+        flat = means.ravel()
+        order = np.argsort(flat, kind='stable')[:weakest]
+        spread = np.percentile(operation_totals[:, index], percentile_points)
+        operations[operation] = {
+            'fact_means': np.round(means, 3).tolist(),
+            'mean_total': round(float(operation_totals[:, index].mean()), 3),
+            'percentiles': {'p' + str(point): round(float(value), 3)
+                            for point, value in zip(percentile_points, spread)},
+            'weakest_facts': fact_list(index, order, means)
+        }
+
+    flat_means = fact_means.reshape(len(OPERATIONS), -1)
+    order = np.argsort(flat_means.ravel(), kind='stable')[:weakest]
+    weakest_facts = []
+    for position in order:
+        operation_index, flat_index = divmod(int(position), GRID_SIZE * GRID_SIZE)
+        weakest_facts.extend(fact_list(operation_index, [flat_index], fact_means[operation_index]))
+
+    # rank 1 is the highest total, ties share the better rank
+    ranking_order = np.lexsort((ids, -totals))
+    sorted_totals = totals[ranking_order]
+    ranks = np.searchsorted(-sorted_totals, -sorted_totals, side='left') + 1
+    percentiles = 100.0 * (count - ranks) / max(count - 1, 1)
+    rankings = []
+    for position in range(min(ranking_limit, count)):
+        student_index = ranking_order[position]
+        rankings.append({
+            'id': int(ids[student_index]),
+            'total': int(totals[student_index]),
+            'totals': {operation: int(operation_totals[student_index, index])
+                       for index, operation in enumerate(OPERATIONS)},
+            'rank': int(ranks[position]),
+            'percentile': round(float(percentiles[position]), 1)
+        })
+
+    return {
+        'students': count,
+        'operations': operations,
+        'weakest_facts': weakest_facts,
+        'rankings': rankings
+    }
@@ -1,32 +1,502 @@
+import csv
+import io
 import logging
-import logging.config
-from flask import Flask, request, jsonify, abort
+import os
+import sys
+import click
+from flask import Flask, Response, request, abort, stream_with_context
 from sqlalchemy import exc
 from flask_cors import CORS
 
-from .database.models import (Class, Student, setup_db, db_drop_and_create_all, db_rollback)
+from .analytics import analyse, load_results
+from .cache import cache, class_key, make_etag, student_key, students_list_key
+from .compression import compress, install as install_compression, negotiate_encoding, set_compressed
+from .jsonio import dumps, install as install_json, json_response
+from .logconfig import install as install_logging, setup_logging
+from .metrics import install as install_metrics
+from .practice import next_questions, PRACTICE_QUESTIONS, PRACTICE_MAX_QUESTIONS
+from .database.models import (Class, Student, setup_db, db_rollback, transactional,
+                              convert_results_storage, record_results, rebuild_class_results,
+                              bulk_insert_students, bulk_delete_students, seed_test_data, sparse,
+                              prune_result_changes, OPERATION_COLUMNS)
+from .database.migrations import db_drop_and_create_all, migrate, verify_schema
 
 # Set up the app
 app = Flask(__name__)
 setup_db(app)
+install_json(app)
+install_metrics(app)
+install_compression(app)
 CORS(app)
 
 print("Starting the AbiMath server")
 
-# Set up logging
-logging.config.fileConfig(fname='logfile.conf', disable_existing_loggers=False)
+# Set up logging (see logconfig.py)
+setup_logging()
+install_logging(app)
 
 # Get the logger specified in the file
 logger = logging.getLogger(__name__)
 logger.debug('STARTING the AbiMath backend')
 
 '''
-@TODO uncomment the following line to initialize the datbase
-!! NOTE THIS WILL DROP ALL RECORDS AND START YOUR DB FROM SCRATCH
-!! NOTE THIS MUST BE UNCOMMENTED ON FIRST RUN
+The database is not changed when the server starts, only its schema version
+is checked and the server refuses to start if it is out of date.  Use the
+flask commands to set it up:
+    flask db-init   creates or migrates the tables to the latest schema
+    flask db-seed   inserts the test data into an empty database
+    flask db-reset  !! DROPS ALL RECORDS and recreates and seeds the database
 '''
+# the flask commands that bring the schema up to date, so they can be run
+# on an out of date database
+SCHEMA_COMMANDS = ('db-init', 'db-reset')
+
+with app.app_context():
+    if not verify_schema():
+        running_schema_command = os.getenv('FLASK_RUN_FROM_CLI') == 'true' and \
+            any(command in sys.argv[1:] for command in SCHEMA_COMMANDS)
+        if not running_schema_command:
+            raise RuntimeError('The database schema is out of date. Run "flask db-init" before starting the server.')
+
+# Student list paging
+# STUDENTS_PAGE_SIZE is the number of students returned when no limit is given
+# STUDENTS_MAX_PAGE_SIZE is the largest limit a client may ask for
+STUDENTS_PAGE_SIZE = int(os.getenv('STUDENTS_PAGE_SIZE', '100'))
+STUDENTS_MAX_PAGE_SIZE = int(os.getenv('STUDENTS_MAX_PAGE_SIZE', '1000'))
+
+# Class list paging
+# CLASSES_PAGE_SIZE is the number of classes returned when no limit is given
+# CLASSES_MAX_PAGE_SIZE is the largest limit a client may ask for
+CLASSES_PAGE_SIZE = int(os.getenv('CLASSES_PAGE_SIZE', '100'))
+CLASSES_MAX_PAGE_SIZE = int(os.getenv('CLASSES_MAX_PAGE_SIZE', '500'))
+
+# Recording results
+# RESULTS_MAX_BATCH is the largest number of results accepted in one request
+RESULTS_MAX_BATCH = int(os.getenv('RESULTS_MAX_BATCH', '1000'))
+
+# Bulk student changes
+# BULK_MAX_ROWS is the largest number of students accepted in one bulk request
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', '10000'))
+
+# Streamed exports
+# STREAM_BATCH_SIZE is the number of rows fetched from the database cursor at a time
+STREAM_BATCH_SIZE = int(os.getenv('STREAM_BATCH_SIZE', '500'))
 
-db_drop_and_create_all()
+# ###################################################################
+def get_int_arg(name, default=None, minimum=None, maximum=None):
+    '''
+    Gets an integer query string argument.
+
+    Returns the default if the argument is not supplied.
+
+    Aborts with status code 400 if the argument is not an integer or is
+    outside the minimum and maximum.
+    '''
+    value = request.args.get(name, None)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, "The " + name + " parameter must be an integer.")
+    if minimum is not None and value < minimum:
+        abort(400, "The " + name + " parameter must be at least " + str(minimum) + ".")
+    if maximum is not None and value > maximum:
+        abort(400, "The " + name + " parameter must be at most " + str(maximum) + ".")
+    return value
+
+# ###################################################################
+def get_students_page(query):
+    '''
+    Gets a page of students using keyset pagination on Student.id.
+
+    The page is selected by the query string arguments
+        limit     the number of students to return (default STUDENTS_PAGE_SIZE)
+        after     only return students with an id greater than this
+        class_id  only return students in this class
+
+    Returns a tuple of the list of students and the id to pass as after to
+    get the next page (None if this is the last page).
+
+    Aborts with status code 422 if there is a database error.
+    '''
+    limit = get_int_arg('limit', STUDENTS_PAGE_SIZE, 1, STUDENTS_MAX_PAGE_SIZE)
+    after = get_int_arg('after')
+    class_id = get_int_arg('class_id')
+
+    if class_id is not None:
+        query = query.filter(Student.class_id == class_id)
+    if after is not None:
+        query = query.filter(Student.id > after)
+
+    # get one extra row to find out if there is another page
+    try:
+        page = query.order_by(Student.id).limit(limit + 1).all()
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+
+    next_after = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_after = page[-1].id
+    return page, next_after
+
+# ###################################################################
+def get_students_page_key():
+    '''
+    Gets the part of a cache key identifying the page of students selected
+    by the limit, after and class_id query string arguments.
+
+    Aborts with status code 400 if the arguments are invalid.
+    '''
+    return ':'.join(str(value) for value in (
+        get_int_arg('limit', STUDENTS_PAGE_SIZE, 1, STUDENTS_MAX_PAGE_SIZE),
+        get_int_arg('after'),
+        get_int_arg('class_id')))
+
+# ###################################################################
+def cached_response(key, build):
+    '''
+    Returns a json response from the response cache, building and caching it
+    with build() on a miss.
+
+    build() returns the json body as a dict and may abort; error responses
+    are not cached.
+
+    The response has an ETag and a request with a matching If-None-Match
+    header gets a 304 response with no body.
+
+    If the client accepts a compressed response the compressed body is
+    also cached, so it is only compressed once per change.
+    '''
+    entry = cache.get(key)
+    if entry is None:
+        body = dumps(build())
+        entry = make_etag(body).encode() + b'\n' + body
+        cache.set(key, entry)
+    etag, body = entry.split(b'\n', 1)
+    etag = etag.decode()
+    encoding = negotiate_encoding(len(body))
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304, mimetype='application/json')
+    elif encoding is None:
+        response = Response(body, mimetype='application/json')
+    else:
+        response = Response(mimetype='application/json')
+        set_compressed(response, cached_compressed(key, etag, body, encoding), encoding)
+    response.set_etag(etag, weak=encoding is not None)
+    return response
+
+# ###################################################################
+def cached_compressed(key, etag, body, encoding):
+    '''
+    Gets the body of the cached response key compressed with encoding,
+    compressing and caching it on a miss.
+    '''
+    compressed_key = key + ':' + etag + ':' + encoding
+    compressed = cache.get(compressed_key)
+    if compressed is None:
+        compressed = compress(body, encoding)
+        cache.set(compressed_key, compressed)
+    return compressed
+
+# ###################################################################
+def check_results_grid(name, grid):
+    '''
+    Checks that a submitted results grid is 10 rows of 10 integers.
+
+    Aborts with status code 400 if it is not.
+    '''
+    if not isinstance(grid, list) or len(grid) != 10:
+        abort(400, "There must be 10 rows in " + name + ".")
+    for row in grid:
+        if not isinstance(row, list) or len(row) != 10:
+            abort(400, "Each row in " + name + " must have 10 columns.")
+        for cell in row:
+            if not isinstance(cell, int) or isinstance(cell, bool):
+                abort(400, "Each value in " + name + " must be an integer.")
+
+# ###################################################################
+def get_result_events(body):
+    '''
+    Gets the practice results submitted to POST /students/<id>/results.
+
+    The body is either a list of results or {"results": [results...]} where
+    each result is {"operation": "mul", "a": 7, "b": 8, "correct": true}.
+
+    Returns a list of (operation, a, b, correct) tuples.
+
+    Aborts with status code 400 if the results are missing or invalid.
+    '''
+    if isinstance(body, dict):
+        body = body.get('results', None)
+    if not isinstance(body, list) or len(body) == 0:
+        abort(400, "Missing input field(s). (a list of results is required.)")
+    if len(body) > RESULTS_MAX_BATCH:
+        abort(400, "Too many results. (at most " + str(RESULTS_MAX_BATCH) + " are allowed.)")
+
+    events = []
+    for index, result in enumerate(body):
+        if not isinstance(result, dict):
+            abort(400, "Result " + str(index) + " must be an object.")
+        operation = result.get('operation', None)
+        a = result.get('a', None)
+        b = result.get('b', None)
+        correct = result.get('correct', None)
+        if operation not in OPERATION_COLUMNS:
+            abort(400, "Result " + str(index) + " operation must be one of add, sub, mul or div.")
+        for value in (a, b):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 1 or value > 10:
+                abort(400, "Result " + str(index) + " a and b must be integers from 1 to 10.")
+        if not isinstance(correct, bool):
+            abort(400, "Result " + str(index) + " correct must be true or false.")
+        events.append((operation, a, b, correct))
+    return events
+
+# ###################################################################
+def get_bulk_students():
+    '''
+    Gets the students submitted to POST /students/bulk.
+
+    The students are either json (a list of {"name", "class_id"} objects or
+    {"students": [...]}) or csv with a name,class_id header row, sent as the
+    request body with a text/csv content type or as an uploaded file.
+
+    Returns a tuple of the list of (name, class_id) tuples for the valid
+    rows, the list of their indexes in the submitted list, and a list of
+    {"row", "message"} errors for the invalid rows, where row is the index
+    of the row in the submitted list.
+
+    Aborts with status code 400 if no students are supplied.
+    '''
+    if 'file' in request.files:
+        text = request.files['file'].read().decode('utf-8-sig')
+        body = list(csv.DictReader(io.StringIO(text)))
+    elif request.mimetype == 'text/csv':
+        body = list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    else:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            body = body.get('students', None)
+
+    if not isinstance(body, list) or len(body) == 0:
+        abort(400, "Missing input field(s). (a list of students with name and class_id is required.)")
+    if len(body) > BULK_MAX_ROWS:
+        abort(400, "Too many students. (at most " + str(BULK_MAX_ROWS) + " are allowed.)")
+
+    students = []
+    rows = []
+    errors = []
+    for index, row in enumerate(body):
+        if not isinstance(row, dict):
+            errors.append({'row': index, 'message': "The student must be an object."})
+            continue
+        name = row.get('name', None)
+        class_id = row.get('class_id', None)
+        if not isinstance(name, str) or name.strip() == '':
+            errors.append({'row': index, 'message': "The name must not be blank."})
+            continue
+        try:
+            class_id = int(class_id)
+        except (TypeError, ValueError):
+            errors.append({'row': index, 'message': "The class_id must be an integer."})
+            continue
+        students.append((name, class_id))
+        rows.append(index)
+    return students, rows, errors
+
+# ###################################################################
+def get_stream_arg():
+    '''
+    Gets the stream query string argument.
+
+    Returns None if the response is not to be streamed, otherwise 'json'
+    or 'ndjson'.
+
+    Aborts with status code 400 if the argument is not recognised.
+    '''
+    stream = request.args.get('stream', None)
+    if stream is None or stream == '':
+        return None
+    if stream not in ('json', 'ndjson'):
+        abort(400, "The stream parameter must be json or ndjson.")
+    return stream
+
+# ###################################################################
+def get_format_arg():
+    '''
+    Gets the format query string argument for the results grids.
+
+    Returns 'dense' (the default) for the full 10x10 grids or 'sparse' for
+    a list of the non-zero cells as [row, col, value] (see sparse_grid).
+
+    Aborts with status code 400 if the argument is not recognised.
+    '''
+    results_format = request.args.get('format', None)
+    if results_format is None or results_format == '':
+        return 'dense'
+    if results_format not in ('dense', 'sparse'):
+        abort(400, "The format parameter must be dense or sparse.")
+    return results_format
+
+# ###################################################################
+def get_members_arg():
+    '''
+    Gets the members query string argument for the classes.
+
+    Returns 'none' (the default) to leave out the students in the class,
+    or 'short' or 'long' for the form of the students to include.
+
+    Aborts with status code 400 if the argument is not recognised.
+    '''
+    members = request.args.get('members', None)
+    if members is None or members == '':
+        return 'none'
+    if members not in ('none', 'short', 'long'):
+        abort(400, "The members parameter must be none, short or long.")
+    return members
+
+# ###################################################################
+def class_representation(schoolclass, form, members, results_format):
+    '''
+    Builds the short or long form of a class with its members in the
+    members form (see get_members_arg) and the results grids in the
+    results_format (see get_format_arg).
+    '''
+    if form == 'short':
+        representation = schoolclass.short()
+    else:
+        representation = schoolclass.long()
+        if results_format == 'sparse':
+            representation = sparse(representation)
+    if members == 'short':
+        representation['members'] = [student.short() for student in schoolclass.classmembers]
+    elif members == 'long':
+        representation['members'] = [student.long() for student in schoolclass.classmembers]
+        if results_format == 'sparse':
+            representation['members'] = [sparse(student) for student in representation['members']]
+    return representation
+
+# ###################################################################
+def stream_rows(query, key, form, stream):
+    '''
+    Streams the rows of query as a json document or as ndjson.
+
+    The rows are read STREAM_BATCH_SIZE at a time from a server side cursor
+    and each row is serialized with form() as it is read, so the memory used
+    does not grow with the number of rows and the first bytes are sent
+    straight away.
+
+    When stream is 'json' the body is {"success": true, key: [rows...]}.
+    When stream is 'ndjson' the body is one json row per line.
+
+    Returns the streamed flask Response.
+    '''
+    def generate_json():
+        yield b'{"success":true,"' + key.encode() + b'":['
+        separator = b''
+        for row in query.yield_per(STREAM_BATCH_SIZE):
+            yield separator + dumps(form(row))
+            separator = b','
+        yield b']}'
+
+    def generate_ndjson():
+        for row in query.yield_per(STREAM_BATCH_SIZE):
+            yield dumps(form(row)) + b'\n'
+
+    def generate():
+        # the status has already been sent so errors can only be logged
+        try:
+            if stream == 'ndjson':
+                yield from generate_ndjson()
+            else:
+                yield from generate_json()
+        except Exception:
+            logger.exception('Error streaming %s', key)
+            raise
+
+    mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+# ###################################################################
+def get_students_stream_query(query):
+    '''
+    Applies the class_id and after query string arguments to a student query
+    for a streamed export. The limit argument is ignored.
+    '''
+    after = get_int_arg('after')
+    class_id = get_int_arg('class_id')
+    if class_id is not None:
+        query = query.filter(Student.class_id == class_id)
+    if after is not None:
+        query = query.filter(Student.id > after)
+    return query.order_by(Student.id)
+
+# ###################################################################
+@app.cli.command('db-init')
+def db_init():
+    '''
+    Creates the database tables or migrates them to the latest schema.
+    '''
+    applied = migrate()
+    for version, description in applied:
+        click.echo('Applied migration ' + str(version) + ': ' + description)
+    click.echo('The database schema is up to date.')
+
+# ###################################################################
+@app.cli.command('db-seed')
+def db_seed():
+    '''
+    Inserts the test classes and students into an empty database.
+    '''
+    if seed_test_data():
+        click.echo('Inserted the test data.')
+    else:
+        click.echo('The database already has classes, the test data was not inserted.')
+
+# ###################################################################
+@app.cli.command('db-reset')
+@click.confirmation_option(prompt='This will drop all the records. Continue?')
+def db_reset():
+    '''
+    Drops all the tables, then recreates and seeds the database.
+    '''
+    db_drop_and_create_all()
+    click.echo('The database has been reset.')
+
+# ###################################################################
+@app.cli.command('convert-results')
+@click.argument('target', type=click.Choice(['json', 'binary']))
+def convert_results(target):
+    '''
+    Converts the stored results grids to the json or binary storage format.
+
+    Set the RESULTS_STORAGE environment variable to the same format before
+    restarting the server.
+    '''
+    converted = convert_results_storage(target)
+    click.echo('Converted the results of ' + str(converted) + ' rows to ' + target + '.')
+
+# ###################################################################
+@app.cli.command('rebuild-class-results')
+@click.option('--class-id', type=int, default=None, help='Only rebuild this class.')
+def rebuild_class_results_command(class_id):
+    '''
+    Recalculates the class results from the results of their students.
+    '''
+    rebuilt = rebuild_class_results(class_id)
+    click.echo('Rebuilt the results of ' + str(rebuilt) + ' classes.')
+
+# ###################################################################
+@app.cli.command('prune-result-changes')
+@click.option('--keep', type=int, default=None, help='Number of recent versions of each student to keep.')
+def prune_result_changes_command(keep):
+    '''
+    Deletes the old recorded student result changes used by delta responses.
+    '''
+    pruned = prune_result_changes() if keep is None else prune_result_changes(keep)
+    click.echo('Deleted ' + str(pruned) + ' result changes.')
 
 # ###################################################################
 @app.route('/')
@@ -52,30 +522,46 @@ def students():
     This is used to get a list of students in the student.short() data format
     and is used to display the names of the students.
 
+    The list is paged using the limit, after and class_id query string
+    arguments (see get_students_page).
+
+    If the stream query string argument is json or ndjson all the students
+    (filtered by class_id and after) are streamed instead (see stream_rows).
+
+    The pages are cached and have an ETag (see cached_response).
+
     Returns
-        status code 200 and json {"success": True, "students": students}
+        status code 200 and json {"success": True, "students": students, "next_after": next_after}
             where students is the list of students
+            and next_after is the after value for the next page (null on the last page)
+        status code 304 if the If-None-Match header matches the page's ETag
+        status code 400 if the paging arguments are invalid
         status code 404 if there are no students
         status code 422 if there is a database error
     '''
-    logger.debug('GET /students')
-    # get all the students
-    try:
-        all_students = Student.query.all()
-    except Exception as e:
-        abort(422, "Unexpected error accessing the database.")
+    stream = get_stream_arg()
+    if stream is not None:
+        query = get_students_stream_query(Student.query_short())
+        return stream_rows(query, 'students', Student.short, stream)
 
-    # return a 404 error if there are no students
-    if len(all_students) is 0:
-        abort(404, 'There are no students')
+    def build():
+        # get a page of the students, only loading the short form columns
+        page, next_after = get_students_page(Student.query_short())
 
-    # get the short form of the students list
-    students = [student.short() for student in all_students]
+        # return a 404 error if there are no students
+        if len(page) == 0 and request.args.get('after') is None:
+            abort(404, 'There are no students')
 
-    return jsonify({
-        'success': True,
-        'students': students
-    }), 200
+        # get the short form of the students list
+        students = [student.short() for student in page]
+
+        return {
+            'success': True,
+            'students': students,
+            'next_after': next_after
+        }
+
+    return cached_response(students_list_key('short', get_students_page_key()), build)
 
 # ###################################################################
 @app.route('/students-detail', methods=['GET'])
@@ -83,35 +569,57 @@ def students():
 # def students_detail(jwt):
 def students_detail():
     '''
-    GET /students is a public endpoint returning a list of students.
+    GET /students-detail is a public endpoint returning a list of students.
 
-    This is used to get a list of students in the student.short() data format
-    and is used to display the names of the students.
+    This is used to get a list of students in the student.long() data format
+    and is used to display the results for each of the students.
+
+    The list is paged using the limit, after and class_id query string
+    arguments (see get_students_page).
+
+    If the stream query string argument is json or ndjson all the students
+    (filtered by class_id and after) are streamed instead (see stream_rows).
+    This is used to export the results for a whole school.
+
+    If the format query string argument is sparse the results grids only
+    list their non-zero cells (see get_format_arg).
+
+    The pages are cached and have an ETag (see cached_response).
 
     Returns
-        status code 200 and json {"success": True, "students": students}
+        status code 200 and json {"success": True, "students": students, "next_after": next_after}
             where students is the list of students
+            and next_after is the after value for the next page (null on the last page)
+        status code 304 if the If-None-Match header matches the page's ETag
+        status code 400 if the paging, stream or format arguments are invalid
         status code 404 if there are no students
         status code 422 if there is a database error
     '''
-    logger.debug('GET /students')
-    # get all the students
-    try:
-        all_students = Student.query.all()
-    except Exception as e:
-        abort(422, "Unexpected error accessing the database.")
+    stream = get_stream_arg()
+    results_format = get_format_arg()
+    form = Student.long if results_format == 'dense' else lambda student: sparse(student.long())
+    if stream is not None:
+        query = get_students_stream_query(Student.query)
+        return stream_rows(query, 'students', form, stream)
 
-    # return a 404 error if there are no students
-    if len(all_students) is 0:
-        abort(404, 'There are no students')
+    def build():
+        # get a page of the students
+        page, next_after = get_students_page(Student.query)
 
-    # get the short form of the students list
-    students = [student.long() for student in all_students]
+        # return a 404 error if there are no students
+        if len(page) == 0 and request.args.get('after') is None:
+            abort(404, 'There are no students')
 
-    return jsonify({
-        'success': True,
-        'students': students
-    }), 200
+        # get the long form of the students list
+        students = [form(student) for student in page]
+
+        return {
+            'success': True,
+            'students': students,
+            'next_after': next_after
+        }
+
+    return cached_response(students_list_key('long', get_students_page_key(), results_format), build)
 
 # ###################################################################
 @app.route('/students/<int:id>', methods=['GET'])
@@ -129,31 +637,59 @@ def students_get(id):
 
     Requires the 'get:students' permission.
 
+    If the format query string argument is sparse the results grids only
+    list their non-zero cells (see get_format_arg).
+
+    If the since query string argument is a version previously returned for
+    the student, only the cells changed since that version are returned as
+    [row, col, value] lists and "delta" is true.  If the changes are no longer
+    recorded all the results are returned and "delta" is false.
+
+    The response is cached and has an ETag (see cached_response).
+
     Returns
         status code 200 and json {"success": True, "students": student}
             where student is an array containing only the requested student
+        status code 304 if the If-None-Match header matches the student's ETag
         status code 400 if there is an error in the submitted data
+        status code 400 if the format or since arguments are invalid
         status code 400 if there are no permissions in the JWT
         status code 401 if the user does not have permission to do this
         status code 404 if <id> is not found in the database
         status code 422 if there is a database error
     '''
-    logger.debug('GET/students/' + str(id))
+    results_format = get_format_arg()
+    since = get_int_arg('since', None, 0)
 
-    # get the student to be returned
-    student = Student.query.filter(Student.id == id).one_or_none()
-    if student is None:
-        abort(404, "id not found in the database.")
+    def build():
+        # get the student to be returned
+        student = Student.query.filter(Student.id == id).one_or_none()
+        if student is None:
+            abort(404, "id not found in the database.")
 
+        # return the long form of the student just retrieved
+        representation = student.long()
+        if since is not None:
+            changes = student.changes_since(since)
+            representation['delta'] = changes is not None
+            if changes is not None:
+                representation.update(changes)
+                return {
+                    'success': True,
+                    'students': [representation]
+                }
+        if results_format == 'sparse':
+            representation = sparse(representation)
+        return {
+            'success': True,
+            'students': [representation]
+        }
 
-    # return the long form of the student just retrieved
-    return jsonify({
-        'success': True,
-        'students': [student.long()]
-    }), 200
+    return cached_response(student_key(id, results_format, since), build)
 
 # ###################################################################
 @app.route('/students/<int:id>', methods=['DELETE'])
+@transactional
 # @requires_auth('delete:students')
 # def students_delete(jwt, id):
 def students_delete(id):
@@ -176,10 +712,9 @@ def students_delete(id):
         status code 404 if <id> is not found in the database
         status code 422 if there is a database error
     '''
-    logger.debug('DELETE/students/' + str(id))
-
-    # get the student to be deleted
-    student = Student.query.filter(Student.id == id).one_or_none()
+    # get the student to be deleted, locking its row so the results
+    # subtracted from its class are not stale (see Student.delete)
+    student = Student.query.filter(Student.id == id).populate_existing().with_for_update().one_or_none()
     if student is None:
         abort(404, "id '" + str(id) + "' not found in the database.")
     try:
@@ -188,7 +723,7 @@ def students_delete(id):
         student.delete()
 
         # return the id of the deleted item
-        return jsonify({
+        return json_response({
             'success': True,
             'delete': id
         }), 200
@@ -199,6 +734,7 @@ def students_delete(id):
 
 # ###################################################################
 @app.route('/students', methods=['POST'])
+@transactional
 # @requires_auth('post:students')
 # def students_create(jwt):
 def students_create():
@@ -220,8 +756,6 @@ def students_create():
         status code 401 if the user does not have the required permission
         status code 422 if there is a database error
     '''
-    logger.debug('POST/students')
-
     # get the input data
     try:
         body = dict(request.form or request.json or request.data)
@@ -244,15 +778,8 @@ def students_create():
     if new_class_id == '':
         abort(400, description="The class_id must not be blank.")
 
-    # ensure that the name is unique in that class
-    # ##################################################################
-    #TODO Check that it is unique in the class not in the whole database
-    # ##################################################################
-    # existing_student = Student.query.filter(Student.name == new_name).one_or_none()
-    existing_student = Student.query.filter((Student.class_id == new_class_id) & (Student.name == new_name)).one_or_none()
-    if existing_student is not None:
-        abort(400, description="Cannot add '" + new_name +
-              "'. That student already exists in the class.")
+    # the name must be unique in the class, this is enforced by the unique
+    # index on (class_id, name) when the student is inserted
     try:
         # start of a rollbackable transaction
         # set up a table of results initialised to zero
@@ -271,16 +798,21 @@ def students_create():
         )
         student.insert()
         # return the long form of the student just inserted
-        return jsonify({
+        return json_response({
             'success': True,
             'students': [student.long()]
         }), 200
+    except exc.IntegrityError as e:
+        db_rollback()
+        abort(400, description="Cannot add '" + new_name +
+              "'. That student already exists in the class.")
     except Exception as e:
         db_rollback()
         abort(422, "Unexpected error inserting the student into the database.")
 
 # ###################################################################
 @app.route('/students/<int:id>', methods=['PATCH'])
+@transactional
 # @requires_auth('patch:students')
 # def students_patch(jwt, id):
 def students_patch(id):
@@ -304,8 +836,6 @@ def students_patch(id):
         status code 404 if <id> is not found in the database
         status code 422 if there is a database error
     '''
-    logger.debug('PATCH/students/' + str(id))
-
     # get the input data
     try:
         body = dict(request.form or request.json or request.data)
@@ -327,8 +857,9 @@ def students_patch(id):
         abort(400, "Bad input field(s). (new class_id, name, addresults, subresults, mulresults and div results must not be blank.)")
 
     # ensure that if the name and/or class_id are changed that the name will be unique in that class
-    # get the existing student that is to be patched
-    student = Student.query.filter(Student.id == id).one_or_none()
+    # get the existing student that is to be patched, locking its row so a
+    # concurrent record_results is not overwritten (see Student.update)
+    student = Student.query.filter(Student.id == id).populate_existing().with_for_update().one_or_none()
     if student is None:
         abort(404, "id not found in the database.")
 
@@ -345,50 +876,652 @@ def students_patch(id):
             abort(400, description="Cannot update '" + new_name +
                 "'. The class_id specified does not exist.")
 
-    # if the class_id or name will be changed, check that the new name will be unique within the new class
-    if ((new_class_id != student.class_id) or (new_name != student.name) ):
-        new_student = Student.query.filter((Student.class_id == new_class_id) & (Student.name == new_name)).one_or_none()
-        if new_student is not None:
-            abort(400, description="Cannot update '" + new_name +
-                "'. That student name already exists in the class.")
+    # the new name must be unique within the new class, this is enforced by
+    # the unique index on (class_id, name) when the student is updated
 
     # check that the results tables are the correct dimensions
-    if new_addresults is not None:
-        if len(new_addresults) != 10:
-            abort(404, "There must be 10 rows in addresults.")
-        else:
-            for row in new_addresults:
-                if len(row) != 10:
-                    abort(404, "Each row in addresults must have 10 columns.")
+    new_results = {
+        'addresults': new_addresults,
+        'subresults': new_subresults,
+        'mulresults': new_mulresults,
+        'divresults': new_divresults
+    }
+    for name, grid in new_results.items():
+        if grid is not None:
+            check_results_grid(name, grid)
 
     # The data should all be valid now, so update the database tables
     try:
         # start of a rollbackable transaction
-        # reget the item to be updated (probably not necessary)
-        student = Student.query.filter(Student.id == id).one_or_none()
-        if student is None:
-            abort(404, "id not found in the database.")
-
         # insert the new data to the student
         if new_class_id is not None:
             student.class_id = new_class_id
         if new_name is not None:
             student.name = new_name
-        
-        # update the add results
-#########################
+
+        # update the results
+        for name, grid in new_results.items():
+            if grid is not None:
+                setattr(student, name, grid)
 
         # commit the changes
         student.update()
 
         # return the long form of the student just updated
-        return jsonify({
+        return json_response({
             'success': True,
             'students': [student.long()]
         }), 200
 
+    except exc.IntegrityError as e:
+        db_rollback()
+        abort(400, description="Cannot update '" + new_name +
+              "'. That student name already exists in the class.")
     except Exception as e:
         db_rollback()
         abort(422, "Unexpected error updating the database.")
 
 
+
+# ###################################################################
+@app.route('/students/<int:id>/results', methods=['POST'])
+@transactional
+# @requires_auth('post:results')
+# def students_results_create(jwt, id):
+def students_results_create(id):
+    '''
+    POST /students/<id>/results is an endpoint to record practice results for <id>.
+
+    This is used to add a batch of answers to the student's results grids.
+    Each result is {"operation": "mul", "a": 7, "b": 8, "correct": true}
+    where operation is one of add, sub, mul or div and a and b are 1 to 10.
+
+    A correct answer adds 1 to the [a-1][b-1] cell of the operation's grid
+    and an incorrect answer subtracts 1.  The cells are incremented inside
+    the database so concurrent submissions are not lost.
+
+    A student with the same <id> must already be in the students table otherwise a
+    404 error is returned if <id> is not found in the students table.
+
+    Requires the 'post:results' permission.
+
+    Returns
+        status code 200 and json {"success": True, "id": id, "recorded": count}
+            where count is the number of results recorded
+        status code 400 if there is an error in the submitted data
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database
+        status code 422 if there is a database error
+    '''
+    # get the input data
+    events = get_result_events(request.get_json(silent=True))
+
+    try:
+        # start of a rollbackable transaction
+        found = record_results(id, events)
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error recording the results.")
+
+    if not found:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+
+    return json_response({
+        'success': True,
+        'id': id,
+        'recorded': len(events)
+    }), 200
+
+# ###################################################################
+@app.route('/students/<int:id>/next-questions', methods=['GET'])
+# @requires_auth('get:students')
+# def students_next_questions(jwt, id):
+def students_next_questions(id):
+    '''
+    GET /students/<id>/next-questions is an endpoint to choose the questions
+    the student <id> should practise next.
+
+    The n questions (default PRACTICE_QUESTIONS) are different facts chosen
+    at random with the weaker facts (more incorrect than correct answers)
+    more likely, so each set is different but concentrates on what the
+    student finds hardest.
+
+    The weights of the student's 400 facts are kept in a cached sampler
+    that is updated as results are recorded (see practice.py), so a request
+    only reads the student's version from the database.
+
+    A student with the same <id> must already be in the students table otherwise a
+    404 error is returned if <id> is not found in the students table.
+
+    Requires the 'get:students' permission.
+
+    Returns
+        status code 200 and json {"success": True, "id": id, "version": version, "questions": questions}
+            where questions is a list of {"operation", "a", "b"}
+        status code 400 if n is invalid
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database
+        status code 422 if there is a database error
+    '''
+    n = get_int_arg('n', PRACTICE_QUESTIONS, 1, PRACTICE_MAX_QUESTIONS)
+
+    try:
+        chosen = next_questions(id, n)
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+    if chosen is None:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+
+    version, questions = chosen
+    return json_response({
+        'success': True,
+        'id': id,
+        'version': version,
+        'questions': [{'operation': operation, 'a': a, 'b': b} for operation, a, b in questions]
+    }), 200
+
+# ###################################################################
+@app.route('/classes', methods=['GET'])
+# @requires_auth('get:classes')
+# def classes(jwt):
+def classes():
+    '''
+    GET /classes is an endpoint returning a list of classes.
+
+    This is used to get a list of classes in the class.short() data format,
+    optionally with the students in each class.
+
+    The list is paged using the limit and after query string arguments
+    like GET /students.
+
+    If the members query string argument is short or long each class has a
+    members list of its students in the student.short() or student.long()
+    data format (see get_members_arg).  The members of all the classes on
+    the page are loaded with one query (see Class.query_members), so the
+    page takes the same number of SQL statements however many classes it
+    has.  If the format query string argument is sparse the long members'
+    results grids only list their non-zero cells (see get_format_arg).
+
+    If the stream query string argument is json or ndjson all the classes
+    (filtered by after) are streamed instead (see stream_rows), e.g.
+    members=long&stream=ndjson to export the results of the whole school
+    class by class.
+
+    Requires the 'get:classes' permission.
+
+    Returns
+        status code 200 and json {"success": True, "classes": classes, "next_after": next_after}
+            where classes is the list of classes
+            and next_after is the after value for the next page (null on the last page)
+        status code 400 if the query string arguments are invalid
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if there are no classes
+        status code 422 if there is a database error
+    '''
+    stream = get_stream_arg()
+    limit = get_int_arg('limit', CLASSES_PAGE_SIZE, 1, CLASSES_MAX_PAGE_SIZE)
+    after = get_int_arg('after')
+    members = get_members_arg()
+    results_format = get_format_arg()
+
+    query = Class.query_members(members)
+    if after is not None:
+        query = query.filter(Class.id > after)
+
+    if stream is not None:
+        # the members are loaded with one query per STREAM_BATCH_SIZE classes
+        form = lambda schoolclass: class_representation(schoolclass, 'short', members, results_format)
+        return stream_rows(query.order_by(Class.id), 'classes', form, stream)
+
+    # get one extra row to find out if there is another page, its members
+    # are loaded with the others
+    try:
+        page = query.order_by(Class.id).limit(limit + 1).all()
+        next_after = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_after = page[-1].id
+        classes = [class_representation(schoolclass, 'short', members, results_format) for schoolclass in page]
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+
+    # return a 404 error if there are no classes
+    if len(classes) == 0 and after is None:
+        abort(404, 'There are no classes')
+
+    return json_response({
+        'success': True,
+        'classes': classes,
+        'next_after': next_after
+    }), 200
+
+# ###################################################################
+@app.route('/classes/<int:id>', methods=['GET'])
+# @requires_auth('get:classes')
+# def classes_get(jwt, id):
+def classes_get(id):
+    '''
+    GET /classes/<id> is an endpoint to get the class <id>.
+
+    This is used to get a class in the class.long() data format, optionally
+    with its students (see GET /classes).
+
+    A class with the same <id> must already be in the classes table otherwise a
+    404 error is returned if <id> is not found in the classes table.
+
+    Requires the 'get:classes' permission.
+
+    Returns
+        status code 200 and json {"success": True, "classes": [schoolclass]}
+            where schoolclass is the class in the class.long() data format
+        status code 400 if the query string arguments are invalid
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database
+        status code 422 if there is a database error
+    '''
+    members = get_members_arg()
+    results_format = get_format_arg()
+
+    try:
+        schoolclass = Class.query_members(members, 'long').filter(Class.id == id).one_or_none()
+        if schoolclass is not None:
+            representation = class_representation(schoolclass, 'long', members, results_format)
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+    if schoolclass is None:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+
+    return json_response({
+        'success': True,
+        'classes': [representation]
+    }), 200
+
+# ###################################################################
+@app.route('/classes', methods=['POST'])
+@transactional
+# @requires_auth('post:classes')
+# def classes_create(jwt):
+def classes_create():
+    '''
+    POST /classes is an endpoint to create a new row in the classes table.
+
+    This is used to add a new class to the classes table using the data
+    supplied in the class.short() data representation.
+
+    A class with the same name must not already be in the classes table.
+
+    Requires the 'post:classes' permission.
+
+    Returns
+        status code 200 and json {"success": True, "classes": schoolclass}
+            where schoolclass is an array containing only the newly created class
+        status code 400 if there is an error in the submitted data
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have the required permission
+        status code 422 if there is a database error
+    '''
+    # get the input data
+    try:
+        body = dict(request.form or request.json or request.data)
+        new_name = body.get('name', None)
+    except Exception as e:
+        abort(400, "Invalid input data. (name is required.)")
+
+    # check that the name has been submitted and is not blank
+    if new_name is None:
+        abort(400, "Missing input field(s). (name is required.)")
+    if not isinstance(new_name, str) or new_name.strip() == '':
+        abort(400, description="The name must not be blank.")
+
+    # the name must be unique, this is enforced by the unique constraint on
+    # classname when the class is inserted
+    try:
+        # start of a rollbackable transaction
+        # a new class has no students so its results are zero
+        new_results = [[0 for x in range(10)] for y in range(10)]
+        schoolclass = Class(
+            classname=new_name,
+            addresults = new_results,
+            subresults = new_results,
+            mulresults = new_results,
+            divresults = new_results
+        )
+        schoolclass.insert()
+        # return the long form of the class just inserted
+        return json_response({
+            'success': True,
+            'classes': [schoolclass.long()]
+        }), 200
+    except exc.IntegrityError as e:
+        db_rollback()
+        abort(400, description="Cannot add '" + new_name + "'. That class already exists.")
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error inserting the class into the database.")
+
+# ###################################################################
+@app.route('/classes/<int:id>', methods=['PATCH'])
+@transactional
+# @requires_auth('patch:classes')
+# def classes_patch(jwt, id):
+def classes_patch(id):
+    '''
+    PATCH /classes/<id> is an endpoint to rename the class <id>.
+
+    The class results are the totals of its students' results so they
+    cannot be changed directly, only the name.
+
+    A class with the same <id> must already be in the classes table otherwise a
+    404 error is returned if <id> is not found in the classes table.
+
+    Requires the 'patch:classes' permission.
+
+    Returns
+        status code 200 and json {"success": True, "classes": schoolclass}
+            where schoolclass is an array containing only the updated class
+        status code 400 if there is an error in the submitted data
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database
+        status code 422 if there is a database error
+    '''
+    # get the input data
+    try:
+        body = dict(request.form or request.json or request.data)
+        new_name = body.get('name', None)
+    except Exception as e:
+        abort(400, "Invalid input data. (name is required.)")
+
+    if new_name is None:
+        abort(400, "Missing input field(s). (name is required.)")
+    if not isinstance(new_name, str) or new_name.strip() == '':
+        abort(400, description="The name must not be blank.")
+
+    schoolclass = Class.query.filter(Class.id == id).one_or_none()
+    if schoolclass is None:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+
+    try:
+        # start of a rollbackable transaction
+        schoolclass.classname = new_name
+        schoolclass.update()
+
+        # return the long form of the class just updated
+        return json_response({
+            'success': True,
+            'classes': [schoolclass.long()]
+        }), 200
+    except exc.IntegrityError as e:
+        db_rollback()
+        abort(400, description="Cannot rename the class to '" + new_name + "'. That class already exists.")
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error updating the database.")
+
+# ###################################################################
+@app.route('/classes/<int:id>', methods=['DELETE'])
+@transactional
+# @requires_auth('delete:classes')
+# def classes_delete(jwt, id):
+def classes_delete(id):
+    '''
+    DELETE /classes/<id> is an endpoint to delete the class <id>.
+
+    Only an empty class can be deleted, its students must be moved to
+    another class or deleted first.
+
+    A class with the same <id> must already be in the classes table otherwise a
+    404 error is returned if <id> is not found in the classes table.
+
+    Requires the 'delete:classes' permission.
+
+    Returns
+        status code 200 and json {"success": True, "delete": id}
+            where id is the id of the deleted class
+        status code 400 if the class has students
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database
+        status code 422 if there is a database error
+    '''
+    # get the class to be deleted
+    schoolclass = Class.query_short().filter(Class.id == id).one_or_none()
+    if schoolclass is None:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+    if schoolclass.has_members():
+        abort(400, "Cannot delete the class '" + schoolclass.classname + "'. It has students.")
+    try:
+        # start of a rollbackable transaction
+        schoolclass.delete()
+
+        # return the id of the deleted item
+        return json_response({
+            'success': True,
+            'delete': id
+        }), 200
+
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error deleting the class from the database.")
+
+# ###################################################################
+@app.route('/classes/<int:id>/results', methods=['GET'])
+# @requires_auth('get:classes')
+# def classes_results(jwt, id):
+def classes_results(id):
+    '''
+    GET /classes/<id>/results is an endpoint to get the results of the class <id>.
+
+    The class results are the totals of the results of the students in the
+    class.  They are kept up to date as student results change so this only
+    reads the one class row.
+
+    A class with the same <id> must already be in the classes table otherwise a
+    404 error is returned if <id> is not found in the classes table.
+
+    Requires the 'get:classes' permission.
+
+    If the format query string argument is sparse the results grids only
+    list their non-zero cells (see get_format_arg).
+
+    The response is cached and has an ETag (see cached_response).
+
+    Returns
+        status code 200 and json {"success": True, "classes": [schoolclass]}
+            where schoolclass is the class in the class.long() data format
+        status code 304 if the If-None-Match header matches the class's ETag
+        status code 400 if the format argument is invalid
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database
+        status code 422 if there is a database error
+    '''
+    results_format = get_format_arg()
+
+    def build():
+        try:
+            schoolclass = Class.query.filter(Class.id == id).one_or_none()
+        except Exception as e:
+            abort(422, "Unexpected error accessing the database.")
+        if schoolclass is None:
+            abort(404, "id '" + str(id) + "' not found in the database.")
+
+        representation = schoolclass.long()
+        if results_format == 'sparse':
+            representation = sparse(representation)
+        return {
+            'success': True,
+            'classes': [representation]
+        }
+
+    return cached_response(class_key(id, 'results', results_format), build)
+
+# ###################################################################
+def analytics_response(class_id):
+    '''
+    Builds the analytics json response for a class, or the whole school if
+    class_id is None, using the weakest and limit query string arguments.
+
+    Aborts with status code 404 if there are no students and 422 if there
+    is a database error.
+    '''
+    weakest = get_int_arg('weakest', 10, 1, 400)
+    ranking_limit = get_int_arg('limit', 100, 0, STUDENTS_MAX_PAGE_SIZE)
+
+    try:
+        ids, results = load_results(class_id)
+    except Exception as e:
+        abort(422, "Unexpected error accessing the database.")
+    if len(ids) == 0:
+        abort(404, 'There are no students')
+
+    analytics = analyse(ids, results, weakest, ranking_limit)
+    analytics['class_id'] = class_id
+    analytics['success'] = True
+    return json_response(analytics), 200
+
+# ###################################################################
+@app.route('/classes/<int:id>/analytics', methods=['GET'])
+# @requires_auth('get:classes')
+# def classes_analytics(jwt, id):
+def classes_analytics(id):
+    '''
+    GET /classes/<id>/analytics is an endpoint to analyse the results of the students in class <id>.
+
+    This is used to show which facts the class finds hardest and how the
+    students rank against each other (see analytics.analyse).
+
+    The query string arguments are
+        weakest  the number of weakest facts to return (default 10)
+        limit    the number of top ranked students to return (default 100)
+
+    Requires the 'get:classes' permission.
+
+    Returns
+        status code 200 and json {"success": True, "class_id": id, "students": count,
+            "operations": operations, "weakest_facts": facts, "rankings": rankings}
+        status code 400 if the query string arguments are invalid
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 404 if <id> is not found in the database or has no students
+        status code 422 if there is a database error
+    '''
+    if Class.query_short().filter(Class.id == id).one_or_none() is None:
+        abort(404, "id '" + str(id) + "' not found in the database.")
+    return analytics_response(id)
+
+# ###################################################################
+@app.route('/analytics', methods=['GET'])
+# @requires_auth('get:classes')
+# def school_analytics(jwt):
+def school_analytics():
+    '''
+    GET /analytics is an endpoint to analyse the results of every student in the school.
+
+    Takes the same query string arguments and returns the same json as
+    GET /classes/<id>/analytics, with a null class_id.
+
+    Requires the 'get:classes' permission.
+    '''
+    return analytics_response(None)
+
+# ###################################################################
+@app.route('/students/bulk', methods=['POST'])
+@transactional
+# @requires_auth('post:students')
+# def students_bulk_create(jwt):
+def students_bulk_create():
+    '''
+    POST /students/bulk is an endpoint to create many new rows in the students table.
+
+    This is used to add a whole school's students at once using json or csv
+    data (see get_bulk_students) with a name and class_id for each student.
+    The results are all set to 0.
+
+    The students are checked with one query for the classes and one for the
+    existing names, and the valid students are inserted in one transaction.
+    A student is rejected if its name is blank, its class does not exist or
+    its name is already used in the class.
+
+    Requires the 'post:students' permission.
+
+    Returns
+        status code 200 and json {"success": True, "inserted": count, "errors": errors}
+            where count is the number of students inserted
+            and errors is a list of {"row", "message"} for each rejected row
+        status code 400 if no students are supplied
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have the required permission
+        status code 422 if there is a database error
+    '''
+    students, rows, errors = get_bulk_students()
+
+    inserted = 0
+    if students:
+        try:
+            # start of a rollbackable transaction
+            inserted, insert_errors = bulk_insert_students(students)
+        except Exception as e:
+            db_rollback()
+            abort(422, "Unexpected error inserting the students into the database.")
+        errors.extend({'row': rows[index], 'message': message} for index, message in insert_errors)
+        errors.sort(key=lambda error: error['row'])
+
+    return json_response({
+        'success': True,
+        'inserted': inserted,
+        'errors': errors
+    }), 200
+
+# ###################################################################
+@app.route('/students/bulk', methods=['DELETE'])
+@transactional
+# @requires_auth('delete:students')
+# def students_bulk_delete(jwt):
+def students_bulk_delete():
+    '''
+    DELETE /students/bulk is an endpoint to delete many rows from the students table.
+
+    This is used to delete the students whose ids are supplied as json,
+    either a list of ids or {"ids": [...]}, in one transaction.  The deleted
+    students' results are subtracted from their classes' results.
+
+    Requires the 'delete:students' permission.
+
+    Returns
+        status code 200 and json {"success": True, "delete": ids, "errors": errors}
+            where ids is the list of deleted ids
+            and errors is a list of {"id", "message"} for each id not found
+        status code 400 if no ids are supplied
+        status code 400 if there are no permissions in the JWT
+        status code 401 if the user does not have permission to do this
+        status code 422 if there is a database error
+    '''
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('ids', None)
+    if not isinstance(body, list) or len(body) == 0:
+        abort(400, "Missing input field(s). (a list of ids is required.)")
+    if len(body) > BULK_MAX_ROWS:
+        abort(400, "Too many ids. (at most " + str(BULK_MAX_ROWS) + " are allowed.)")
+    for id in body:
+        if not isinstance(id, int) or isinstance(id, bool):
+            abort(400, "Each id must be an integer.")
+
+    try:
+        # start of a rollbackable transaction
+        deleted, missing = bulk_delete_students(body)
+    except Exception as e:
+        db_rollback()
+        abort(422, "Unexpected error deleting the students from the database.")
+
+    return json_response({
+        'success': True,
+        'delete': deleted,
+        'errors': [{'id': id, 'message': "id '" + str(id) + "' not found in the database."}
+                   for id in missing]
+    }), 200
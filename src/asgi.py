@@ -0,0 +1,314 @@
+'''
+ASGI entry point for serving the AbiMath backend with an async server, e.g.
+
+    uvicorn src.asgi:application --workers 2
+
+The polling endpoints GET /students and GET /students/<id> are handled by
+async views that read the database through an async SQLAlchemy engine, so
+one process can hold many concurrent slow clients without a thread each.
+Every other request (and the less common forms of those two, such as
+streamed exports, since=<version> deltas and error responses) is passed to
+the flask app, which runs in a thread pool.
+
+The async views share the response cache, ETags and compression with the
+flask views.  Their requests are counted in the /metrics request counts,
+durations and sizes, but not in the per request SQL and timing metrics.
+'''
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.http import parse_accept_header, parse_etags
+
+from .api import app, cached_compressed, STUDENTS_PAGE_SIZE, STUDENTS_MAX_PAGE_SIZE
+from .auth.auth import AuthError
+from .cache import cache, make_etag, student_key, students_list_key
+from .compression import choose_encoding
+from .database.models import (Student, normalise_database_url, sparse, DATABASE_URL, RESULTS_COLUMNS,
+                              DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+                              DB_POOL_PRE_PING, SQLITE_BUSY_TIMEOUT)
+from .jsonio import dumps
+from .logconfig import log_request, LOG_REQUESTS
+from .metrics import observe, METRICS_ENABLED
+
+logger = logging.getLogger(__name__)
+
+# Async database settings
+# ASYNC_DATABASE_URL is the database used by the async views, by default
+# DATABASE_URL with its async driver (aiosqlite for sqlite, asyncpg for postgres)
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL', None)
+
+# the async driver for each database
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg'
+}
+
+
+# ###################################################################
+def async_database_url(database_url):
+    '''
+    Converts a database url to the same database with its async driver.
+    '''
+    url = make_url(normalise_database_url(database_url))
+    if url.drivername in ASYNC_DRIVERS.values():
+        return url
+    if url.drivername not in ASYNC_DRIVERS:
+        raise ValueError('There is no async driver for ' + url.drivername + ', set ASYNC_DATABASE_URL.')
+    return url.set(drivername=ASYNC_DRIVERS[url.drivername])
+
+# ###################################################################
+def async_engine_options(url):
+    '''
+    Builds the create_async_engine options for the database url.
+    '''
+    if url.get_backend_name() == 'sqlite':
+        options = {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT / 1000.0}}
+        if url.database and url.database != ':memory:':
+            # aiosqlite runs a thread per connection, so keep them open in a pool
+            options.update(poolclass=AsyncAdaptedQueuePool, pool_size=DB_POOL_SIZE,
+                           max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+        return options
+    return {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+url = async_database_url(ASYNC_DATABASE_URL or DATABASE_URL)
+engine = create_async_engine(url, **async_engine_options(url))
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+# the flask app for everything the async views do not handle
+flask_application = WsgiToAsgi(app)
+
+student_table = Student.__table__
+# the columns of Student.short() and Student.long() in the same order
+SHORT_COLUMNS = (student_table.c.id, student_table.c.class_id, student_table.c.name)
+LONG_COLUMNS = SHORT_COLUMNS + (student_table.c.version,) + tuple(student_table.c[name] for name in RESULTS_COLUMNS)
+
+
+class Request:
+    '''
+    Request. The parts of an ASGI http request used by the async views.
+    '''
+    def __init__(self, scope):
+        self.path = scope['path']
+        self.args = {name: values[0] for name, values in
+                     parse_qs(scope['query_string'].decode('latin-1'), keep_blank_values=True).items()}
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+class Fallback(Exception):
+    '''
+    Fallback Exception. Raised by an async view to pass the request to the
+    flask app instead.
+    '''
+
+
+# ###################################################################
+def get_int_arg(request, name, default=None, minimum=None, maximum=None):
+    '''
+    Gets an integer query string argument (see api.get_int_arg).
+
+    Raises Fallback if the argument is invalid so flask returns the error.
+    '''
+    value = request.args.get(name, None)
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise Fallback()
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise Fallback()
+    return value
+
+# ###################################################################
+async def cached_response(request, key, build):
+    '''
+    Async version of api.cached_response using the same cache entries.
+
+    build() is a coroutine returning the json body as a dict, and raises
+    Fallback instead of returning an error.
+
+    Returns a tuple of the status, the list of headers and the body.
+    '''
+    entry = cache.get(key)
+    if entry is None:
+        body = dumps(await build())
+        entry = make_etag(body).encode() + b'\n' + body
+        cache.set(key, entry)
+    etag, body = entry.split(b'\n', 1)
+    etag = etag.decode()
+    encoding = choose_encoding(parse_accept_header(request.headers.get('accept-encoding')), len(body))
+
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'vary', b'Accept-Encoding'),
+        (b'etag', (('W/' if encoding is not None else '') + '"' + etag + '"').encode())
+    ]
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return 304, headers, b''
+    if encoding is not None:
+        body = cached_compressed(key, etag, body, encoding)
+        headers.append((b'content-encoding', encoding.encode()))
+    return 200, headers, body
+
+# ###################################################################
+# @arequires_auth('get:students')
+# async def students(request, jwt):
+async def students(request):
+    '''
+    Async version of the GET /students endpoint (see api.students).
+
+    Streamed exports are passed to the flask app.
+    '''
+    if request.args.get('stream'):
+        raise Fallback()
+    limit = get_int_arg(request, 'limit', STUDENTS_PAGE_SIZE, 1, STUDENTS_MAX_PAGE_SIZE)
+    after = get_int_arg(request, 'after')
+    class_id = get_int_arg(request, 'class_id')
+
+    async def build():
+        query = select(*SHORT_COLUMNS)
+        if class_id is not None:
+            query = query.where(student_table.c.class_id == class_id)
+        if after is not None:
+            query = query.where(student_table.c.id > after)
+        # get one extra row to find out if there is another page
+        async with Session() as session:
+            rows = (await session.execute(query.order_by(student_table.c.id).limit(limit + 1))).all()
+
+        # flask returns the 404 error if there are no students
+        if len(rows) == 0 and after is None:
+            raise Fallback()
+
+        page = [dict(row._mapping) for row in rows[:limit]]
+        return {
+            'success': True,
+            'students': page,
+            'next_after': page[-1]['id'] if len(rows) > limit else None
+        }
+
+    page_key = ':'.join(str(value) for value in (limit, after, class_id))
+    return await cached_response(request, students_list_key('short', page_key), build)
+
+# ###################################################################
+# @arequires_auth('get:students')
+# async def students_get(request, jwt, id):
+async def students_get(request, id):
+    '''
+    Async version of the GET /students/<id> endpoint (see api.students_get).
+
+    since=<version> delta requests are passed to the flask app.
+    '''
+    results_format = request.args.get('format') or 'dense'
+    if request.args.get('since') or results_format not in ('dense', 'sparse'):
+        raise Fallback()
+
+    async def build():
+        async with Session() as session:
+            row = (await session.execute(select(*LONG_COLUMNS).where(student_table.c.id == id))).first()
+
+        # flask returns the 404 error if the student is not found
+        if row is None:
+            raise Fallback()
+
+        representation = dict(row._mapping)
+        if results_format == 'sparse':
+            representation = sparse(representation)
+        return {
+            'success': True,
+            'students': [representation]
+        }
+
+    return await cached_response(request, student_key(id, results_format, None), build)
+
+
+# the async views for GET requests as (path pattern, flask route, view)
+ROUTES = (
+    (re.compile(r'^/students$'), '/students', students),
+    (re.compile(r'^/students/(\d+)$'), '/students/<int:id>', lambda request, id: students_get(request, int(id))),
+)
+
+
+# ###################################################################
+async def send_response(send, status, headers, body, request):
+    '''
+    Sends a complete http response.
+    '''
+    headers = headers + [(b'content-length', str(len(body)).encode())]
+    # the same header flask-cors adds for the default allow all origins
+    if 'origin' in request.headers:
+        headers.append((b'access-control-allow-origin', b'*'))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+# ###################################################################
+async def lifespan(receive, send):
+    '''
+    Handles the ASGI lifespan messages, closing the database connections on
+    shutdown.
+    '''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+# ###################################################################
+async def application(scope, receive, send):
+    '''
+    The ASGI application.
+
+    GET requests matching ROUTES are handled by the async views, everything
+    else by the flask app.
+    '''
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        for pattern, endpoint, view in ROUTES:
+            match = pattern.match(scope['path'])
+            if match is None:
+                continue
+            start = time.perf_counter()
+            request = Request(scope)
+            try:
+                status, headers, body = await view(request, *match.groups())
+            except Fallback:
+                break
+            except AuthError as e:
+                status = e.status_code
+                headers = [(b'content-type', b'application/json')]
+                body = dumps({'success': False, 'error': status, 'message': e.error['description']})
+            except Exception:
+                # let flask deal with (and report) the error
+                logger.exception('Error in the async view for %s', scope['path'])
+                break
+            await send_response(send, status, headers, body, request)
+            seconds = time.perf_counter() - start
+            if METRICS_ENABLED:
+                observe(endpoint, 'GET', status, seconds, len(body))
+            if LOG_REQUESTS:
+                log_request('GET', scope['path'] + ('?' + scope['query_string'].decode('latin-1')
+                                                    if scope['query_string'] else ''), status, seconds)
+            return
+
+    await flask_application(scope, receive, send)
@@ -0,0 +1,271 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Response cache settings
+# CACHE_BACKEND selects where cached responses are kept
+#   memory  an LRU cache in each server process (the default)
+#   redis   a shared redis server at CACHE_URL (needs the redis package)
+#   fake    an in-process stand in for redis, for local testing
+#   none    responses are not cached
+# With the memory backend each process only sees its own invalidations, so
+# CACHE_TTL bounds how stale another process's cached responses can be.
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory').lower()
+CACHE_URL = os.getenv('CACHE_URL', 'redis://localhost:6379/0')
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '4096'))
+CACHE_TTL = int(os.getenv('CACHE_TTL', '60'))
+CACHE_PREFIX = os.getenv('CACHE_PREFIX', 'abimath:')
+
+
+class LRUCache:
+    '''
+    LRUCache. A thread safe in-process cache of bytes values with a maximum
+    number of entries and a time to live.
+    '''
+    def __init__(self, max_entries=4096, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            value = int(entry[1]) + 1 if entry is not None else 1
+            # counters never expire so they are not evicted before the entries they version
+            self._entries[key] = (None, str(value).encode())
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FakeRedis:
+    '''
+    FakeRedis. A minimal in-process stand in for a redis client supporting
+    the get, set, delete, incr and flushdb commands used by RedisCache.
+    '''
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._expired(key)
+            return None if entry is None else entry[1]
+
+    def set(self, key, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode()
+        with self._lock:
+            self._data[key] = (time.monotonic() + ex if ex else None, value)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def incr(self, key):
+        with self._lock:
+            entry = self._expired(key)
+            value = int(entry[1]) + 1 if entry is not None else 1
+            self._data[key] = (entry[0] if entry is not None else None, str(value).encode())
+            return value
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisCache:
+    '''
+    RedisCache. A cache kept in redis (or anything with the same get, set,
+    delete, incr and flushdb commands, such as FakeRedis) so that every
+    server process shares the cached responses and invalidations.
+
+    Errors talking to the server are logged and treated as cache misses.
+    '''
+    def __init__(self, client, ttl=60, prefix=''):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.warning('Cache get failed: %s', e)
+            return None
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            self.client.set(self.prefix + key, value, ex=ttl or None)
+        except Exception as e:
+            logger.warning('Cache set failed: %s', e)
+
+    def delete(self, *keys):
+        try:
+            self.client.delete(*[self.prefix + key for key in keys])
+        except Exception as e:
+            logger.warning('Cache delete failed: %s', e)
+
+    def incr(self, key):
+        try:
+            return self.client.incr(self.prefix + key)
+        except Exception as e:
+            logger.warning('Cache incr failed: %s', e)
+            return None
+
+    def clear(self):
+        try:
+            self.client.flushdb()
+        except Exception as e:
+            logger.warning('Cache clear failed: %s', e)
+
+
+class NullCache:
+    '''
+    NullCache. A cache that never holds anything.
+    '''
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def incr(self, key):
+        return None
+
+    def clear(self):
+        pass
+
+
+# ###################################################################
+def create_cache(backend=CACHE_BACKEND):
+    '''
+    Creates the cache for the backend (see CACHE_BACKEND).
+    '''
+    if backend == 'memory':
+        return LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+    if backend == 'redis':
+        # redis is only needed when it is used
+        import redis
+        return RedisCache(redis.Redis.from_url(CACHE_URL), CACHE_TTL, CACHE_PREFIX)
+    if backend == 'fake':
+        return RedisCache(FakeRedis(), CACHE_TTL, CACHE_PREFIX)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError("CACHE_BACKEND must be 'memory', 'redis', 'fake' or 'none'.")
+
+
+cache = create_cache()
+
+
+# ###################################################################
+def generation(name):
+    '''
+    Gets the current generation of a cached resource.
+
+    Cache keys include the generation of the resource they depend on, so
+    invalidating a resource is a single increment of its generation and the
+    old entries are simply never read again.
+    '''
+    value = cache.get('generation:' + name)
+    return value.decode() if isinstance(value, bytes) else str(value or 0)
+
+# ###################################################################
+def student_key(id, *parts):
+    '''
+    Builds the cache key of a response for the student id.
+    '''
+    return ':'.join(['student', str(id), generation('student:' + str(id))] + [str(part) for part in parts])
+
+# ###################################################################
+def students_list_key(form, *parts):
+    '''
+    Builds the cache key of a page of the students list in the short or
+    long form.
+    '''
+    return ':'.join(['students', form, generation('students:' + form)] + [str(part) for part in parts])
+
+# ###################################################################
+def class_key(id, *parts):
+    '''
+    Builds the cache key of a response for the class id.
+    '''
+    return ':'.join(['class', str(id), generation('class:' + str(id))] + [str(part) for part in parts])
+
+# ###################################################################
+def invalidate_students(ids, short_changed=True):
+    '''
+    Invalidates the cached responses for the students ids and the student
+    lists.
+
+    The short form lists are only invalidated if short_changed is set, i.e.
+    a student was added, deleted, renamed or moved class; results changes
+    leave them cached.
+    '''
+    for id in ids:
+        if id is not None:
+            cache.incr('generation:student:' + str(id))
+    cache.incr('generation:students:long')
+    if short_changed:
+        cache.incr('generation:students:short')
+
+# ###################################################################
+def invalidate_classes(ids):
+    '''
+    Invalidates the cached responses for the classes ids.
+    '''
+    for id in ids:
+        if id is not None:
+            cache.incr('generation:class:' + str(id))
+
+# ###################################################################
+def make_etag(body):
+    '''
+    Returns the etag of a response body.
+    '''
+    return hashlib.sha1(body).hexdigest()
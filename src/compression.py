@@ -0,0 +1,115 @@
+import gzip
+import os
+import time
+
+from flask import request
+
+from .metrics import add_timing
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Response compression
+# COMPRESS_MIN_SIZE is the smallest response body in bytes that is compressed
+# COMPRESS_LEVEL is the gzip compression level, 1 (fastest) to 9 (smallest)
+# COMPRESS_BROTLI_QUALITY is the brotli quality, 0 (fastest) to 11 (smallest)
+# COMPRESS_MIMETYPES are the response types that are compressed
+# brotli is only offered if the brotli package is installed (pip install brotli)
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '500'))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))
+COMPRESS_MIMETYPES = set(os.getenv('COMPRESS_MIMETYPES', 'application/json,text/html,text/plain').split(','))
+
+# in order of preference when the client accepts several equally
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+# ###################################################################
+def negotiate_encoding(size):
+    '''
+    Chooses the content encoding for a response body of size bytes from the
+    request's Accept-Encoding header (see choose_encoding).
+    '''
+    return choose_encoding(request.accept_encodings, size)
+
+# ###################################################################
+def choose_encoding(accept_encodings, size):
+    '''
+    Chooses the content encoding for a response body of size bytes.
+
+    @INPUTS
+        accept_encodings: the parsed Accept-Encoding header (a werkzeug Accept)
+
+    Returns 'br', 'gzip' or None if the body is smaller than
+    COMPRESS_MIN_SIZE or the client does not accept a supported encoding.
+    '''
+    if size < COMPRESS_MIN_SIZE:
+        return None
+    best = None
+    best_quality = 0
+    for encoding in ENCODINGS:
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best = encoding
+            best_quality = quality
+    return best
+
+# ###################################################################
+def compress(data, encoding):
+    '''
+    Compresses data with the content encoding 'br' or 'gzip'.
+
+    The time taken is added to the request's compress timing (see metrics).
+    '''
+    start = time.perf_counter()
+    if encoding == 'br':
+        data = brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+    add_timing('compress', time.perf_counter() - start)
+    return data
+
+# ###################################################################
+def set_compressed(response, data, encoding):
+    '''
+    Sets the body of response to data compressed with encoding.
+
+    A strong ETag is made weak, as the compressed body is a different
+    representation of the same data.
+    '''
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+# ###################################################################
+def compress_response(response):
+    '''
+    Compresses a response if the client accepts it (after_request hook).
+
+    Streamed responses, responses that are already encoded, error responses
+    and responses that are not one of the COMPRESS_MIMETYPES are sent as
+    they are.
+    '''
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    data = response.get_data()
+    encoding = negotiate_encoding(len(data))
+    if encoding is not None:
+        set_compressed(response, compress(data, encoding), encoding)
+    return response
+
+# ###################################################################
+def install(app):
+    '''
+    Compresses the flask app's responses (see compress_response).
+    '''
+    app.after_request(compress_response)
@@ -0,0 +1,154 @@
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, Table, func, inspect, select, text
+
+from ..cache import cache
+from ..practice import samplers
+from .models import Class, Student, StudentResultChange, db, seed_test_data
+
+logger = logging.getLogger(__name__)
+
+# the single row table holding the version of the schema in the database
+schema_metadata = MetaData()
+schema_version_table = Table(
+    'schema_version', schema_metadata,
+    Column('version', Integer, nullable=False)
+)
+
+# the migrations in version order, see migration()
+MIGRATIONS = []
+
+# ###################################################################
+def migration(version, description):
+    '''
+    @migration(version, description) decorator method.
+
+    Registers the decorated function as the migration to the schema version.
+    The function is called with a connection inside the migration's
+    transaction.
+
+    Migrations must be idempotent (e.g. check that a column does not exist
+    before adding it) as a database created by an earlier migration using
+    the current models may already have the change.
+    '''
+    def migration_decorator(f):
+        MIGRATIONS.append((version, description, f))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return f
+    return migration_decorator
+
+# ###################################################################
+@migration(1, 'Create the class and student tables')
+def create_tables(connection):
+    db.metadata.create_all(bind=connection, tables=[Class.__table__, Student.__table__], checkfirst=True)
+
+# ###################################################################
+@migration(2, 'Add the student (class_id, name) unique index and class_id index')
+def add_student_indexes(connection):
+    student_table = Student.__table__
+    existing = {index['name'] for index in inspect(connection).get_indexes(student_table.name)}
+    if 'uq_student_class_id_name' not in existing:
+        duplicates = connection.execute(
+            select(student_table.c.class_id, student_table.c.name)
+            .group_by(student_table.c.class_id, student_table.c.name)
+            .having(func.count() > 1)).fetchall()
+        if duplicates:
+            raise RuntimeError('Rename or delete the duplicate students before migrating: ' +
+                               ', '.join("'" + row.name + "' in class " + str(row.class_id) for row in duplicates))
+    for index in student_table.indexes:
+        if index.name not in existing:
+            index.create(bind=connection)
+
+# ###################################################################
+@migration(3, 'Add the student version column and the student_result_change table')
+def add_student_versions(connection):
+    columns = {column['name'] for column in inspect(connection).get_columns(Student.__tablename__)}
+    if 'version' not in columns:
+        connection.execute(text('ALTER TABLE student ADD COLUMN version INTEGER DEFAULT 0 NOT NULL'))
+    db.metadata.create_all(bind=connection, tables=[StudentResultChange.__table__], checkfirst=True)
+
+# ###################################################################
+def latest_version():
+    '''
+    Returns the schema version the models expect.
+    '''
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+# ###################################################################
+def schema_version(connection):
+    '''
+    Gets the schema version of the database.
+
+    Returns 0 if the database has never been migrated.
+    '''
+    if not inspect(connection).has_table(schema_version_table.name):
+        return 0
+    version = connection.execute(select(schema_version_table.c.version)).scalar()
+    return version or 0
+
+# ###################################################################
+def migrate():
+    '''
+    Brings the database schema up to the latest version.
+
+    Each pending migration and the new schema version are committed
+    together, so an interrupted run can simply be repeated.
+
+    Returns a list of the (version, description) of the migrations applied.
+    '''
+    applied = []
+    with db.engine.begin() as connection:
+        schema_metadata.create_all(bind=connection, checkfirst=True)
+        if connection.execute(select(schema_version_table.c.version)).first() is None:
+            connection.execute(schema_version_table.insert().values(version=0))
+
+    for version, description, apply in MIGRATIONS:
+        with db.engine.begin() as connection:
+            if schema_version(connection) >= version:
+                continue
+            logger.info('Migrating the database to version %s: %s', version, description)
+            apply(connection)
+            connection.execute(schema_version_table.update().values(version=version))
+        applied.append((version, description))
+    return applied
+
+# ###################################################################
+def verify_schema():
+    '''
+    Checks that the database schema is at the latest version without
+    changing it.  Called when the server starts.
+
+    Returns True if the schema is up to date, otherwise logs an error and
+    returns False.
+    '''
+    try:
+        with db.engine.connect() as connection:
+            version = schema_version(connection)
+    except Exception as e:
+        logger.error('Unable to read the database schema version: %s', e)
+        return False
+    if version != latest_version():
+        logger.error('The database schema is version %s but version %s is required. Run "flask db-init".',
+                     version, latest_version())
+        return False
+    logger.debug('The database schema is version %s', version)
+    return True
+
+# ###################################################################
+def db_drop_and_create_all():
+    '''
+    Drops the database tables and starts a fresh database.
+
+    Can be used to initialize a clean the database.
+    The tables are recreated by the migrations and the test data
+    (two classes and three students) is inserted, and the response cache
+    and practice samplers are cleared.
+
+    !!NOTE THIS WILL DROP ALL RECORDS
+    '''
+    db.drop_all()
+    schema_metadata.drop_all(bind=db.engine, checkfirst=True)
+    migrate()
+    seed_test_data()
+    cache.clear()
+    samplers.clear()
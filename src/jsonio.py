@@ -0,0 +1,93 @@
+import json
+import os
+import time
+
+import flask
+from flask import Response
+
+from .metrics import add_timing
+
+# JSON serialization
+# JSON_ENCODER selects the encoder used for the api responses
+#   auto    orjson if it is installed, otherwise the standard library (the default)
+#   orjson  orjson, which must be installed (pip install orjson)
+#   stdlib  the standard library json module
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto').lower()
+
+if JSON_ENCODER not in ('auto', 'orjson', 'stdlib'):
+    raise ValueError("JSON_ENCODER must be 'auto', 'orjson' or 'stdlib'.")
+
+orjson = None
+if JSON_ENCODER != 'stdlib':
+    try:
+        import orjson
+    except ImportError:
+        if JSON_ENCODER == 'orjson':
+            raise
+
+# the encoder is built once; compact separators and no circular reference
+# check, the results grids are plain nested lists
+_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, check_circular=False)
+
+
+# ###################################################################
+def dumps(obj):
+    '''
+    Serializes obj to compact json.
+
+    orjson writes the utf-8 bytes directly from the nested lists and dicts;
+    the standard library encoder builds a str which is then encoded.
+
+    The time taken is added to the request's json timing (see metrics).
+
+    Returns the json as bytes.
+    '''
+    start = time.perf_counter()
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        data = _encoder.encode(obj).encode('utf-8')
+    add_timing('json', time.perf_counter() - start)
+    return data
+
+# ###################################################################
+def json_response(obj, status=200):
+    '''
+    Returns a flask Response with obj serialized by dumps().
+
+    This replaces flask.jsonify, which always uses the standard library
+    encoder and sorts the keys.
+    '''
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+# ###################################################################
+def install(app):
+    '''
+    Makes the flask app serialize json with dumps() where flask allows it.
+
+    Flask 2.2 and later use a pluggable json provider so jsonify() and
+    returning a dict from a view also use dumps().  Earlier versions only
+    have the encoder class setting, so the views call json_response()
+    directly; pretty printing is turned off in either case.
+    '''
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
+    app.config['JSON_SORT_KEYS'] = False
+
+    provider_class = getattr(getattr(flask, 'json', None), 'provider', None)
+    if provider_class is None:
+        return
+
+    class JSONProvider(provider_class.DefaultJSONProvider):
+        sort_keys = False
+        compact = True
+
+        def dumps(self, obj, **kwargs):
+            if kwargs:
+                return super().dumps(obj, **kwargs)
+            return dumps(obj).decode('utf-8')
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+    app.json = JSONProvider(app)
@@ -0,0 +1,175 @@
+import atexit
+import json
+import logging
+import logging.config
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+from flask import g, request
+
+# Logging
+# LOG_CONFIG is the logging config file (see logfile.conf for the levels)
+# LOG_QUEUE sends the log records through a queue to the handlers on a
+# background thread, so a slow console or disk never delays a request
+# LOG_FORMAT is text for the format in LOG_CONFIG or json for one json
+# object per line with the structured request fields
+# LOG_REQUESTS logs one record per request with its method, path, status
+# and duration
+LOG_CONFIG = os.getenv('LOG_CONFIG', os.path.join(os.path.dirname(__file__), 'logfile.conf'))
+LOG_QUEUE = os.getenv('LOG_QUEUE', 'true').lower() in ('1', 'true', 'yes')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+LOG_REQUESTS = os.getenv('LOG_REQUESTS', 'true').lower() in ('1', 'true', 'yes')
+
+if LOG_FORMAT not in ('text', 'json'):
+    raise ValueError("LOG_FORMAT must be 'text' or 'json'.")
+
+# the logger of the per request records
+request_logger = logging.getLogger('src.requests')
+
+# the fields of the per request records
+REQUEST_FIELDS = ('method', 'path', 'status', 'duration_ms')
+
+_setup_lock = threading.Lock()
+_configured = False
+_listeners = []
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    '''
+    LazyQueueHandler. A QueueHandler that leaves the formatting of the
+    message to the listener thread.
+
+    The standard QueueHandler formats the message (and any traceback) in
+    the logging thread so the record can be pickled; the queue here is only
+    read by a thread in the same process, so the record is passed as it is.
+    Log arguments should be values that are not changed after logging them.
+    '''
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    JsonFormatter. Formats a record as one json object per line, including
+    the structured request fields when they are set.
+    '''
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }
+        for field in REQUEST_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+# ###################################################################
+def setup_logging():
+    '''
+    Configures logging from LOG_CONFIG, once per process.
+
+    If LOG_QUEUE is true the handlers of each configured logger are moved
+    behind a LazyQueueHandler and run by a QueueListener thread, which is
+    stopped (flushing the queue) when the process exits.
+    '''
+    global _configured
+    with _setup_lock:
+        if _configured:
+            return
+        _configured = True
+
+        logging.config.fileConfig(fname=LOG_CONFIG, disable_existing_loggers=False)
+
+        loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                           if isinstance(logger, logging.Logger)]
+        queue_handlers = {}
+        for logger in loggers:
+            if not logger.handlers:
+                continue
+            if LOG_FORMAT == 'json':
+                for handler in logger.handlers:
+                    handler.setFormatter(JsonFormatter())
+            if not LOG_QUEUE:
+                continue
+            # loggers sharing the same handlers share one queue and thread
+            handlers = tuple(logger.handlers)
+            if handlers not in queue_handlers:
+                records = queue.SimpleQueue()
+                listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+                listener.start()
+                _listeners.append(listener)
+                queue_handlers[handlers] = LazyQueueHandler(records)
+            logger.handlers = [queue_handlers[handlers]]
+
+        if _listeners:
+            atexit.register(stop_logging)
+
+# ###################################################################
+def stop_logging():
+    '''
+    Stops the QueueListener threads once their queued records are handled.
+    '''
+    while _listeners:
+        _listeners.pop().stop()
+
+# ###################################################################
+def log_request(method, path, status, seconds):
+    '''
+    Logs the structured record of a finished request.
+    '''
+    duration_ms = round(seconds * 1000, 2)
+    request_logger.info('%s %s %s %sms', method, path, status, duration_ms, extra={
+        'method': method,
+        'path': path,
+        'status': status,
+        'duration_ms': duration_ms
+    })
+
+# ###################################################################
+def start_request():
+    '''
+    Notes the start of the request (before_request hook).
+    '''
+    g.log_start = time.perf_counter()
+
+# ###################################################################
+def note_status(response):
+    '''
+    Notes the response status (after_request hook).
+    '''
+    g.log_status = response.status_code
+    return response
+
+# ###################################################################
+def end_request(error=None):
+    '''
+    Logs the request's record (teardown_request hook).
+
+    A streamed response is torn down once it has been sent, so its
+    duration covers the whole stream.
+    '''
+    start = g.pop('log_start', None)
+    if start is None:
+        return
+    log_request(request.method, request.full_path.rstrip('?'), g.pop('log_status', 500),
+                time.perf_counter() - start)
+
+# ###################################################################
+def install(app):
+    '''
+    Logs a record of each of the flask app's requests, unless LOG_REQUESTS
+    is false.
+    '''
+    if not LOG_REQUESTS:
+        return
+    app.before_request(start_request)
+    app.after_request(note_status)
+    app.teardown_request(end_request)
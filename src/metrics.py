@@ -0,0 +1,316 @@
+import os
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Request metrics
+# METRICS_ENABLED records the request metrics and serves them at /metrics
+# SERVER_TIMING adds a Server-Timing header with the request's timings to
+# each response, so they show in the browser's developer tools
+# The metrics are kept per process, so with several workers each one
+# reports its own requests.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'false').lower() in ('1', 'true', 'yes')
+
+# the histogram buckets (upper bounds) of each kind of measurement
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENTS_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# the timings kept for each request as (name, Server-Timing description)
+TIMINGS = (
+    ('db', 'database'),
+    ('json', 'json serialization'),
+    ('auth', 'auth verification'),
+    ('compress', 'compression'),
+)
+
+
+class Histogram:
+    '''
+    Histogram. A Prometheus histogram with labels.
+    '''
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self._series = {}
+
+    def observe(self, label_values, value):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series.setdefault(label_values, [0] * len(self.buckets) + [0, 0])
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' histogram']
+        for label_values, series in sorted(self._series.items()):
+            labels = ','.join(name + '="' + escape_label(value) + '"' for name, value in zip(self.labels, label_values))
+            prefix = labels + ',' if labels else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append(self.name + '_bucket{' + prefix + 'le="' + format_value(bound) + '"} ' + str(count))
+            lines.append(self.name + '_bucket{' + prefix + 'le="+Inf"} ' + str(series[-1]))
+            lines.append(self.name + '_sum{' + labels + '} ' + format_value(series[-2]))
+            lines.append(self.name + '_count{' + labels + '} ' + str(series[-1]))
+        return lines
+
+
+class Counter:
+    '''
+    Counter. A Prometheus counter with labels.
+    '''
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._series = {}
+
+    def inc(self, label_values, value=1):
+        self._series[label_values] = self._series.get(label_values, 0) + value
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.description, '# TYPE ' + self.name + ' counter']
+        for label_values, value in sorted(self._series.items()):
+            labels = ','.join(name + '="' + escape_label(value) + '"' for name, value in zip(self.labels, label_values))
+            lines.append(self.name + '{' + labels + '} ' + format_value(value))
+        return lines
+
+
+# the metrics, updated under _lock
+_lock = threading.Lock()
+REQUESTS = Counter('abimath_requests_total', 'Requests by endpoint, method and status.',
+                   ('endpoint', 'method', 'status'))
+REQUEST_SECONDS = Histogram('abimath_request_duration_seconds', 'Request duration.',
+                            ('endpoint', 'method'), SECONDS_BUCKETS)
+SQL_STATEMENTS = Histogram('abimath_request_sql_statements', 'SQL statements executed per request.',
+                           ('endpoint', 'method'), STATEMENTS_BUCKETS)
+TIMING_SECONDS = Histogram('abimath_request_timing_seconds',
+                           'Time per request spent in the database, json serialization, auth verification and '
+                           'compression.', ('endpoint', 'method', 'timing'), SECONDS_BUCKETS)
+RESPONSE_BYTES = Histogram('abimath_response_size_bytes', 'Response body size as sent.',
+                           ('endpoint', 'method'), BYTES_BUCKETS)
+METRICS = (REQUESTS, REQUEST_SECONDS, SQL_STATEMENTS, TIMING_SECONDS, RESPONSE_BYTES)
+
+# the functions that return the values of the metrics kept by other modules
+# (see register_collector)
+_collectors = []
+
+
+class RequestMetrics:
+    '''
+    RequestMetrics. The measurements of one request, kept in flask.g.
+    '''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.timings = dict.fromkeys(name for name, description in TIMINGS)
+        self.size = None
+        self.status = None
+
+
+# ###################################################################
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# ###################################################################
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# ###################################################################
+def current():
+    '''
+    Returns the RequestMetrics of the current flask request, or None
+    outside a request or if metrics are disabled.
+    '''
+    if not has_request_context():
+        return None
+    return g.get('request_metrics', None)
+
+# ###################################################################
+def add_timing(name, seconds):
+    '''
+    Adds seconds to the named timing (see TIMINGS) of the current request.
+
+    Does nothing outside a flask request, e.g. in the flask commands.
+    '''
+    metrics = current()
+    if metrics is not None:
+        metrics.timings[name] = (metrics.timings[name] or 0.0) + seconds
+
+# ###################################################################
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+# ###################################################################
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['metrics_start'].pop()
+    metrics = current()
+    if metrics is not None:
+        metrics.statements += 1
+        metrics.timings['db'] = (metrics.timings['db'] or 0.0) + time.perf_counter() - start
+
+# ###################################################################
+def handle_error(context):
+    # a failed statement does not reach after_cursor_execute
+    if context.connection is not None and context.connection.info.get('metrics_start'):
+        context.connection.info['metrics_start'].pop()
+
+# ###################################################################
+def get_endpoint():
+    '''
+    Returns the route of the current request, e.g. /students/<int:id>, so
+    the requests for every student are counted together.
+    '''
+    rule = request.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+# ###################################################################
+def observe(endpoint, method, status, seconds, size, statements=None, timings=None):
+    '''
+    Records the measurements of a finished request.
+    '''
+    labels = (endpoint, method)
+    with _lock:
+        REQUESTS.inc(labels + (str(status),))
+        REQUEST_SECONDS.observe(labels, seconds)
+        if size is not None:
+            RESPONSE_BYTES.observe(labels, size)
+        if statements is not None:
+            SQL_STATEMENTS.observe(labels, statements)
+        for name, value in (timings or {}).items():
+            if value is not None:
+                TIMING_SECONDS.observe(labels + (name,), value)
+
+# ###################################################################
+def start_request():
+    '''
+    Starts measuring the request (before_request hook).
+    '''
+    g.request_metrics = RequestMetrics()
+
+# ###################################################################
+def count_bytes(chunks, metrics):
+    '''
+    Passes on the chunks of a streamed response, adding up their size.
+    '''
+    metrics.size = 0
+    for chunk in chunks:
+        metrics.size += len(chunk)
+        yield chunk
+
+# ###################################################################
+def finish_response(response):
+    '''
+    Notes the response status and size and adds the Server-Timing header
+    (after_request hook).
+
+    This runs after the compression hook so the compressed size is
+    recorded.  The size of a streamed response without a Content-Length is
+    added up as it is sent.
+    '''
+    metrics = current()
+    if metrics is None:
+        return response
+    metrics.status = response.status_code
+    if response.content_length is not None:
+        metrics.size = response.content_length
+    elif response.is_streamed:
+        response.response = count_bytes(response.response, metrics)
+
+    if SERVER_TIMING:
+        parts = ['app;dur=' + format_milliseconds(time.perf_counter() - metrics.start)]
+        for name, description in TIMINGS:
+            if metrics.timings[name] is not None:
+                parts.append(name + ';dur=' + format_milliseconds(metrics.timings[name]) + ';desc="' + description + '"')
+        parts.append('sql;desc="' + str(metrics.statements) + ' statements"')
+        response.headers['Server-Timing'] = ', '.join(parts)
+    return response
+
+# ###################################################################
+def format_milliseconds(seconds):
+    return '{:.2f}'.format(seconds * 1000)
+
+# ###################################################################
+def end_request(error=None):
+    '''
+    Records the request's measurements (teardown_request hook).
+
+    A streamed response is torn down once it has been sent, so its
+    duration covers the whole stream.
+    '''
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+        return
+    observe(get_endpoint(), request.method, metrics.status or 500, time.perf_counter() - metrics.start,
+            metrics.size, metrics.statements, metrics.timings)
+
+# ###################################################################
+def register_collector(collect):
+    '''
+    Adds metrics kept by another module, e.g. the token cache counters, to
+    /metrics.
+
+    collect is called each time the metrics are rendered and returns a list
+    of (name, type, description, value) tuples, where type is counter or
+    gauge.
+    '''
+    _collectors.append(collect)
+
+# ###################################################################
+def render_collected(name, kind, description, value):
+    return ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' ' + kind, name + ' ' + format_value(value)]
+
+# ###################################################################
+def render():
+    '''
+    Returns the metrics in the Prometheus text format.
+    '''
+    lines = []
+    with _lock:
+        for metric in METRICS:
+            lines.extend(metric.render())
+    for collect in _collectors:
+        for name, kind, description, value in collect():
+            lines.extend(render_collected(name, kind, description, value))
+    return '\n'.join(lines) + '\n'
+
+# ###################################################################
+# @requires_auth('get:metrics')
+# def metrics_view(jwt):
+def metrics_view():
+    '''
+    GET /metrics is a public endpoint that returns the request metrics in
+    the Prometheus text format, for a Prometheus server to scrape.
+
+    Returns
+        status code 200 and the metrics as text/plain
+    '''
+    return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ###################################################################
+def install(app):
+    '''
+    Records the flask app's request metrics and adds the /metrics endpoint,
+    unless METRICS_ENABLED is false.
+
+    Install this before the compression so its after_request hook runs
+    after the compression hook (flask runs them in reverse order).
+    '''
+    if not METRICS_ENABLED:
+        return
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', handle_error)
+    app.before_request(start_request)
+    app.after_request(finish_response)
+    app.teardown_request(end_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view, methods=['GET'])
@@ -0,0 +1,232 @@
+import math
+import os
+import random
+import threading
+from array import array
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .cache import LRUCache
+from .database.models import Student, db, GRID_SIZE, OPERATION_COLUMNS, RESULTS_COLUMNS
+
+# Practice questions
+# PRACTICE_QUESTIONS is the number of questions returned when n is not given
+# PRACTICE_MAX_QUESTIONS is the largest n a client may ask for
+# PRACTICE_TEMPERATURE is how quickly the weight of a fact falls as its
+# result (correct minus incorrect answers) rises; smaller is steeper
+# PRACTICE_MIN_WEIGHT is the weight of a mastered fact relative to the
+# weakest facts (1000), so mastered facts are still revised occasionally
+# PRACTICE_CACHE_SIZE is the number of students' samplers kept per process
+PRACTICE_QUESTIONS = int(os.getenv('PRACTICE_QUESTIONS', '20'))
+PRACTICE_MAX_QUESTIONS = int(os.getenv('PRACTICE_MAX_QUESTIONS', '100'))
+PRACTICE_TEMPERATURE = float(os.getenv('PRACTICE_TEMPERATURE', '2.0'))
+PRACTICE_MIN_WEIGHT = int(os.getenv('PRACTICE_MIN_WEIGHT', '10'))
+PRACTICE_CACHE_SIZE = int(os.getenv('PRACTICE_CACHE_SIZE', '4096'))
+
+# the operation of each results column, the facts are numbered in the
+# order of RESULTS_COLUMNS then row then column
+COLUMN_OPERATIONS = {name: operation for operation, name in OPERATION_COLUMNS.items()}
+FACTS = len(RESULTS_COLUMNS) * GRID_SIZE * GRID_SIZE
+
+# the weights are integers so the tree's sums stay exact as they are updated
+MAX_WEIGHT = 1000
+# results beyond this are weighted the same (the weight is flat there)
+SCORE_LIMIT = 50
+
+
+# ###################################################################
+def fact_weight(score):
+    '''
+    The sampling weight of a fact from its result (correct minus incorrect
+    answers): MAX_WEIGHT / 2 for an unpractised fact, approaching
+    MAX_WEIGHT as it goes negative and PRACTICE_MIN_WEIGHT as it goes
+    positive.
+    '''
+    score = max(-SCORE_LIMIT, min(SCORE_LIMIT, score))
+    return max(PRACTICE_MIN_WEIGHT, int(round(MAX_WEIGHT / (1.0 + math.exp(score / PRACTICE_TEMPERATURE)))))
+
+
+# the weight of each result from -SCORE_LIMIT to SCORE_LIMIT
+WEIGHTS = [fact_weight(score) for score in range(-SCORE_LIMIT, SCORE_LIMIT + 1)]
+
+
+# ###################################################################
+def score_weight(score):
+    '''
+    Looks up fact_weight(score) in WEIGHTS.
+    '''
+    return WEIGHTS[max(-SCORE_LIMIT, min(SCORE_LIMIT, score)) + SCORE_LIMIT]
+
+
+class FenwickTree:
+    '''
+    FenwickTree. A binary indexed tree of integer weights supporting a
+    weight update and finding the item at a cumulative weight in
+    O(log n).
+    '''
+    def __init__(self, weights):
+        size = len(weights)
+        tree = array('q', [0]) + array('q', weights)
+        # build in O(n) by adding each node into its parent
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                tree[parent] += tree[index]
+        self.size = size
+        self.tree = tree
+        self.total = sum(weights)
+        # the largest power of two not above size, where find() starts
+        self._top = 1 << (size.bit_length() - 1) if size else 0
+
+    def add(self, index, delta):
+        '''
+        Adds delta to the weight of item index.
+        '''
+        self.total += delta
+        index += 1
+        tree = self.tree
+        while index <= self.size:
+            tree[index] += delta
+            index += index & -index
+
+    def find(self, target):
+        '''
+        Finds the item whose cumulative weight range contains target, i.e.
+        the first item whose cumulative weight is above target, for
+        0 <= target < total.
+        '''
+        tree = self.tree
+        position = 0
+        step = self._top
+        while step:
+            next_position = position + step
+            if next_position <= self.size and tree[next_position] <= target:
+                position = next_position
+                target -= tree[next_position]
+            step >>= 1
+        return position
+
+
+class PracticeSampler:
+    '''
+    PracticeSampler. A weighted sampler over a student's facts, weaker facts
+    weighted higher (see fact_weight), that is kept up to date by applying
+    the changes to the student's results.
+    '''
+    def __init__(self, grids, version):
+        self.version = version
+        self.scores = array('q', (score for name in RESULTS_COLUMNS for row in grids[name] for score in row))
+        self.weights = array('q', (score_weight(score) for score in self.scores))
+        self.tree = FenwickTree(self.weights)
+        self._lock = threading.Lock()
+
+    def apply_deltas(self, deltas, version):
+        '''
+        Applies the change to the student's results, in the same form as
+        results_deltas, reweighting only the changed facts.
+        '''
+        with self._lock:
+            for name, cells in deltas.items():
+                offset = RESULTS_COLUMNS.index(name) * GRID_SIZE * GRID_SIZE
+                for (row, col), change in cells.items():
+                    fact = offset + row * GRID_SIZE + col
+                    self.scores[fact] += change
+                    self.set_weight(fact, score_weight(self.scores[fact]))
+            self.version = version
+
+    def set_weight(self, fact, weight):
+        self.tree.add(fact, weight - self.weights[fact])
+        self.weights[fact] = weight
+
+    def sample(self, n, rng=random):
+        '''
+        Chooses n different facts at random in proportion to their weights.
+
+        Each chosen fact's weight is set to zero until all n are chosen, so
+        it takes O(n log 400) whatever the results.
+
+        Returns a list of (operation, a, b) tuples.
+        '''
+        with self._lock:
+            chosen = []
+            for index in range(min(n, FACTS)):
+                if self.tree.total <= 0:
+                    break
+                fact = self.tree.find(rng.randrange(self.tree.total))
+                chosen.append((fact, self.weights[fact]))
+                self.set_weight(fact, 0)
+            for fact, weight in chosen:
+                self.set_weight(fact, weight)
+
+        questions = []
+        for fact, weight in chosen:
+            column, cell = divmod(fact, GRID_SIZE * GRID_SIZE)
+            row, col = divmod(cell, GRID_SIZE)
+            questions.append((COLUMN_OPERATIONS[RESULTS_COLUMNS[column]], row + 1, col + 1))
+        return questions
+
+
+# the samplers of the recently practised students, by student id
+samplers = LRUCache(PRACTICE_CACHE_SIZE, ttl=0)
+
+
+# ###################################################################
+def get_sampler(student_id, version):
+    '''
+    Gets the sampler of the student at version, building it from the
+    student's results if it is not cached or is out of date.
+
+    Returns None if the student is not found.
+    '''
+    sampler = samplers.get(student_id)
+    if sampler is not None and sampler.version == version:
+        return sampler
+
+    row = db.session.query(Student.version, *[getattr(Student, name) for name in RESULTS_COLUMNS]) \
+        .filter(Student.id == student_id).one_or_none()
+    if row is None:
+        return None
+    sampler = PracticeSampler({name: getattr(row, name) for name in RESULTS_COLUMNS}, row.version)
+    samplers.set(student_id, sampler)
+    return sampler
+
+# ###################################################################
+def next_questions(student_id, n, rng=random):
+    '''
+    Chooses n practice questions for the student, weaker facts more often.
+
+    Only the student's version is read from the database when the sampler
+    is cached and current, so the results grids are not decoded and
+    reweighted on every request.
+
+    Returns a tuple of the student's version and the list of (operation,
+    a, b) questions, or None if the student is not found.
+    '''
+    version = db.session.query(Student.version).filter(Student.id == student_id).scalar()
+    if version is None:
+        return None
+    sampler = get_sampler(student_id, version)
+    if sampler is None:
+        return None
+    return sampler.version, sampler.sample(n, rng)
+
+# ###################################################################
+@event.listens_for(Session, 'after_commit')
+def update_samplers(session):
+    '''
+    Applies the committed results changes (see models.mark_results_changed)
+    to the cached samplers.
+
+    A sampler that is not at the version before the change (another process
+    changed the student in between) is dropped and rebuilt when next used,
+    as is the sampler of a deleted student.
+    '''
+    for student_id, version, deltas in session.info.pop('changed_results', ()):
+        sampler = samplers.get(student_id)
+        if sampler is None:
+            continue
+        if deltas is not None and sampler.version == version - 1:
+            sampler.apply_deltas(deltas, version)
+        else:
+            samplers.delete(student_id)
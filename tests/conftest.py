@@ -0,0 +1,68 @@
+'''
+The server settings are read when the app is imported, so the tests point
+them at a scratch sqlite database, which is migrated before the app is
+imported (the server refuses to start on an out of date schema).
+
+Run the tests from the project root:
+
+    python -m pytest tests
+'''
+import os
+import tempfile
+
+import pytest
+from flask import Flask
+
+handle, DATABASE_PATH = tempfile.mkstemp(prefix='abimath-test-', suffix='.db')
+os.close(handle)
+DATABASE_URL = 'sqlite:///' + DATABASE_PATH
+
+os.environ['DATABASE_URL'] = DATABASE_URL
+os.environ['CACHE_BACKEND'] = 'none'
+os.environ['LOG_REQUESTS'] = 'false'
+
+
+@pytest.fixture(scope='session')
+def app():
+    from src.database.migrations import migrate
+    from src.database.models import setup_db
+
+    scratch = Flask(__name__)
+    setup_db(scratch, DATABASE_URL)
+    with scratch.app_context():
+        migrate()
+
+    from src.api import app
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def sql_statements(app):
+    '''
+    Returns a function that calls fn and returns the list of SQL statements
+    it executed.
+    '''
+    from sqlalchemy import event
+    from src.database.models import db
+
+    with app.app_context():
+        engine = db.engine
+    statements = []
+
+    def execute(*args):
+        statements.append(args[2])
+
+    event.listen(engine, 'before_cursor_execute', execute)
+
+    def executed(fn):
+        start = len(statements)
+        fn()
+        return statements[start:]
+
+    yield executed
+    event.remove(engine, 'before_cursor_execute', execute)
@@ -0,0 +1,55 @@
+'''
+Listing classes with their members loads the members of the whole page
+with one query, so it takes the same number of SQL statements for 1 class
+as for many.
+'''
+import pytest
+
+from src.database.models import Class, Student, db, GRID_SIZE, RESULTS_COLUMNS
+
+CLASSES = 20
+CLASS_SIZE = 3
+
+
+@pytest.fixture
+def first_class(app):
+    '''
+    Inserts CLASSES classes of CLASS_SIZE students.
+
+    Returns the id of the class before the first one, for the after
+    parameter.
+    '''
+    zero = [[0] * GRID_SIZE for row in range(GRID_SIZE)]
+    with app.app_context():
+        after = db.session.query(db.func.max(Class.id)).scalar() or 0
+        db.session.bulk_insert_mappings(Class, [
+            dict({'id': after + index + 1, 'classname': 'Statements class ' + str(after + index + 1)},
+                 **{name: zero for name in RESULTS_COLUMNS})
+            for index in range(CLASSES)])
+        db.session.bulk_insert_mappings(Student, [
+            dict({'class_id': after + index // CLASS_SIZE + 1, 'name': 'Student ' + str(index)},
+                 **{name: zero for name in RESULTS_COLUMNS})
+            for index in range(CLASSES * CLASS_SIZE)])
+        db.session.commit()
+    return after
+
+
+@pytest.mark.parametrize('members', ['none', 'short', 'long'])
+def test_classes_statements_do_not_grow_with_the_classes(client, sql_statements, first_class, members):
+    pages = {}
+    statements = {}
+    for limit in (1, CLASSES):
+        url = '/classes?members={}&after={}&limit={}'.format(members, first_class, limit)
+
+        def get():
+            response = client.get(url)
+            assert response.status_code == 200
+            pages[limit] = response.get_json()['classes']
+
+        statements[limit] = len(sql_statements(get))
+
+    assert len(pages[1]) == 1
+    assert len(pages[CLASSES]) == CLASSES
+    if members != 'none':
+        assert all(len(schoolclass['members']) == CLASS_SIZE for schoolclass in pages[CLASSES])
+    assert statements[1] == statements[CLASSES]
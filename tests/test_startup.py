@@ -0,0 +1,88 @@
+'''
+Starting the server only checks the schema version, it does not drop,
+recreate or reseed the database.
+'''
+import os
+import subprocess
+import sys
+import tempfile
+
+from src.database.migrations import latest_version, schema_version, verify_schema
+from src.database.models import Class, Student, db, seed_test_data
+
+from .conftest import DATABASE_URL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imports the app in a fresh interpreter and prints the seconds it took
+STARTUP_SCRIPT = '''
+import time
+start = time.perf_counter()
+import src.api
+print(time.perf_counter() - start)
+'''
+
+# a generous bound on the start up, which reseeded the database before
+STARTUP_SECONDS = 10
+
+
+def start_server(database_url):
+    environment = dict(os.environ, DATABASE_URL=database_url)
+    return subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], env=environment, cwd=ROOT,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def seed():
+    '''
+    Seeds the test data and changes it, so a reseed would be noticed.
+
+    Returns the snapshot of the data.
+    '''
+    seed_test_data()
+    Student.query.filter(Student.id == 1).update({'name': 'Changed since seeding'})
+    db.session.commit()
+    return snapshot()
+
+
+def snapshot():
+    students = db.session.query(Student.id, Student.name, Student.version).order_by(Student.id).all()
+    classes = db.session.query(Class.id, Class.classname).order_by(Class.id).all()
+    return students, classes
+
+
+def test_verify_schema_only_reads_the_version(app, sql_statements):
+    with app.app_context():
+        before = seed()
+
+        statements = sql_statements(verify_schema)
+        assert len(statements) <= 2
+        assert all(statement.lstrip().upper().startswith(('SELECT', 'PRAGMA')) for statement in statements)
+        assert verify_schema()
+        assert snapshot() == before
+
+
+def test_startup_does_not_change_the_database(app):
+    with app.app_context():
+        before = seed()
+
+    result = start_server(DATABASE_URL)
+    assert result.returncode == 0, result.stderr
+    seconds = float(result.stdout.strip().splitlines()[-1])
+    assert seconds < STARTUP_SECONDS
+
+    with app.app_context():
+        db.session.expire_all()
+        assert snapshot() == before
+        with db.engine.connect() as connection:
+            assert schema_version(connection) == latest_version()
+
+
+def test_startup_refuses_an_out_of_date_schema():
+    handle, path = tempfile.mkstemp(prefix='abimath-test-', suffix='.db')
+    os.close(handle)
+    try:
+        result = start_server('sqlite:///' + path)
+    finally:
+        os.remove(path)
+    assert result.returncode != 0
+    assert 'flask db-init' in result.stderr